@@ -1,6 +1,8 @@
-from app.extensions import db, login_manager, ldap_manager
+from app.extensions import db, login_manager, ldap_manager, raiseload_by_default
+from app.serializers import OrjsonRequest
 
 from flask import Flask
+from sqlalchemy import event
 
 
 def create_app():
@@ -9,6 +11,9 @@ def create_app():
     # accepts both /endpoint and /endpoint/ as valid URLs
     app.url_map.strict_slashes = False
 
+    # request.get_json() parses bodies with orjson
+    app.request_class = OrjsonRequest
+
     config_app(app)
 
     register_blueprints(app)
@@ -36,18 +41,27 @@ def register_extensions(app):
     """Register Flask extensions."""
 
     db.init_app(app)
+    if app.config.get("SQLALCHEMY_RAISELOAD") and not event.contains(
+        db.session, "do_orm_execute", raiseload_by_default
+    ):
+        event.listen(db.session, "do_orm_execute", raiseload_by_default)
 
     login_manager.init_app(app)
     ldap_manager.init_app(app)
 
-    with app.app_context():
-        # Importing models for creation on application start
-        # Could be removed when DB is already app & running
-        from app.login.auth import User
-        from app.core.models import Cluster, Step
-
-        # db.drop_all()
-        db.create_all()
+    # Creating the schema is a DDL round-trip per worker on every boot, so it is
+    # only done where the DB isn't managed beforehand (i.e. local development).
+    if app.config.get("AUTO_CREATE_SCHEMA"):
+        # Models must be imported for their tables to be created
+        from app.login import auth  # noqa: F401
+        from app.core import models  # noqa: F401
+
+        with app.app_context():
+            # db.drop_all()
+            db.create_all()
+            # With gunicorn's preload_app this runs in the master, so its pooled
+            # connection must be closed before the workers fork and share it.
+            db.engine.dispose()
 
 
 def custom_config(app):
@@ -6,6 +6,7 @@ from .v1.steps import api as step
 from app.apis.login import api as login
 
 from .v1.cluster_config import api as cluster_config
+from app.serializers import output_json
 
 from flask import Blueprint
 from flask_restx import Api
@@ -71,4 +72,8 @@ api.add_namespace(step, path="/step")
 api.add_namespace(cluster_config, path="/config")
 
 
+for _api in (health_check_api, login_api, api):
+    _api.representation("application/json")(output_json)
+
+
 blueprints = [health_check_bp, login_blueprint, blueprint]
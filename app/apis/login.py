@@ -3,7 +3,7 @@ from melitk import logging
 
 from app.login.auth import validate_user
 from app.login.errors import UnableToLoginError
-from app.apis.schemas import AuthSchema
+from app.apis.schemas import auth_schema
 
 from flask import request
 from flask_login import current_user, login_user
@@ -20,14 +20,20 @@ logger = logging.getLogger(__name__)
 class Login(Resource):
     @api.doc("Login endpoint")
     def post(self):
+        if current_user.is_authenticated:
+            return "is_authenticated", 200
+
+        body = request.get_json(silent=True)
+        if body is None:
+            api.abort(
+                HTTPStatus.BAD_REQUEST, message="The request must have a JSON body"
+            )
+
         try:
-            username, password = self.parse_auth_body(request.get_json(force=True))
+            username, password = self.parse_auth_body(body)
         except ValidationError as e:
             api.abort(HTTPStatus.BAD_REQUEST, message=str(e))
 
-        if current_user.is_authenticated:
-            return "is_authenticated", 200
-
         try:
             user = validate_user(username, password)
         except UnableToLoginError:
@@ -39,9 +45,8 @@ class Login(Resource):
 
     def parse_auth_body(self, body: dict):
         try:
-            # auth_schema podría ser variable de clase
-            auth_schema = AuthSchema().load(body)
+            auth = auth_schema.load(body)
         except ValidationError as e:
             logger.error("Unable to parse body - msg: {}".format(e))
             raise
-        return auth_schema["username"], auth_schema["password"]
+        return auth["username"], auth["password"]
@@ -1,4 +1,4 @@
-from marshmallow import Schema, fields
+from marshmallow import EXCLUDE, Schema, fields
 
 BigQueueMessageSchema = Schema.from_dict(
     {"steps": fields.List(fields.Int(), required=True)}
@@ -17,6 +17,8 @@ BigQueueBodySchema = Schema.from_dict(
         "recipientCallback": fields.Str(),
     }
 )
+# Only `msg` is used by the manager, so the rest of the envelope is not validated.
+bigq_steps_schema = BigQueueBodySchema(only=("msg",), unknown=EXCLUDE)
 
 
 FuryJobBodySchema = Schema.from_dict(
@@ -26,5 +28,7 @@ FuryJobBodySchema = Schema.from_dict(
         "job_name": fields.Raw(),
     }
 )
+fury_schema = FuryJobBodySchema()
 
 AuthSchema = Schema.from_dict({"username": fields.Str(), "password": fields.Str()})
+auth_schema = AuthSchema()
@@ -2,6 +2,7 @@ from http import HTTPStatus
 
 from app.extensions import db
 from app.core.models import ClusterConfiguration
+from app.apis.v1.utils import get_json_body
 
 from flask import request
 from flask_login import login_required
@@ -43,7 +44,7 @@ class Configuration(Resource):
     @api.marshal_with(cluster_config_model, code=HTTPStatus.OK)
     def post(self):
 
-        body = request.get_json(force=True)
+        body = get_json_body()
         cluster_configuration = ClusterConfiguration(**body)
         cluster_configuration.upload()
 
@@ -1,33 +1,55 @@
 from http import HTTPStatus
 from datetime import datetime, timedelta
 
+from app import metrics_sink
 from app.extensions import db
-from app.utils import logger
+from app.core import (
+    ADD_JOB_FLOW_STEPS_BUCKET,
+    RUN_JOB_FLOW_BUCKET,
+    TERMINATE_JOB_FLOWS_BUCKET,
+)
 from app.core.errors import (
     CreateClusterError,
     StepCreationError,
+    ThrottledError,
     UnableToAssignStepError,
 )
-from app.core.models import Cluster, Step
-from app.core.aws_handler import EMRHandler
-from app.apis.v1.utils import generate_config
+from app.core.models import Cluster, PAYLOAD_GROUP, Step
+from app.apis.v1.utils import (
+    acquire_or_abort,
+    generate_config,
+    get_json_body,
+    get_or_abort,
+    PAGINATION_PARAMS,
+    paginate,
+    query_filters,
+    stream_marshalled,
+)
 from app.apis.v1.steps import step_model
 
-from flask import request
+from flask import g, request
 from flask_login import login_required, current_user
 from flask_restx import Namespace, Resource, fields
-from melitk import metrics
-from melitk.metrics.exceptions import MetricsError
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import undefer_group
 
 
 api = Namespace("Clusters", description="CRUD for free clusters")
 
+CLUSTER_FILTER_COLUMNS = {"id", "status", "user"}
+
+
+def request_utcnow() -> datetime:
+    """Returns utcnow() once per request, so that every marshalled row shares it."""
+    if "utcnow" not in g:
+        g.utcnow = datetime.utcnow()
+    return g.utcnow
+
 
 def minutes_remaining(cluster):
-    if cluster.status in cluster.TERMINATED_STATUS:
+    if cluster.status in cluster.TERMINATED_STATUS or cluster.terminate_on is None:
         return None
-    return (cluster.terminate_on - datetime.utcnow()).total_seconds() / 60
+    return (cluster.terminate_on - request_utcnow()).total_seconds() / 60
 
 
 cluster_model = api.model(
@@ -55,13 +77,17 @@ cluster_model = api.model(
 
 @api.route("/")
 class Clusters(Resource):
-    @api.marshal_list_with(cluster_model, code=HTTPStatus.OK)
+    @api.doc(params=PAGINATION_PARAMS)
+    @api.response(HTTPStatus.OK, "Success", [cluster_model])
     def get(self):
         """Queries the API DB for all clusters and returns information about them."""
 
-        clusters = Cluster.query.filter_by(**request.args).all()
+        filters = query_filters(request.args, CLUSTER_FILTER_COLUMNS)
+        clusters = paginate(
+            Cluster.query.filter_by(**filters), request.args, order_by=Cluster.id
+        )
 
-        return clusters
+        return stream_marshalled(clusters, cluster_model)
 
     @login_required
     @api.marshal_with(cluster_model, code=HTTPStatus.CREATED)
@@ -71,7 +97,7 @@ class Clusters(Resource):
         a JSON must be passed as a header to specify the configuration of the cluster."""
 
         # TODO: validate input
-        cluster_definition = request.get_json(force=True)
+        cluster_definition = get_json_body()
 
         job_flow_config = generate_config(cluster_definition["cluster_config"])
         del cluster_definition["cluster_config"]
@@ -79,6 +105,7 @@ class Clusters(Resource):
 
         try:
             cluster = Cluster(**cluster_definition)
+            acquire_or_abort(RUN_JOB_FLOW_BUCKET)
             cluster.create()
             db.session.add(cluster)
             db.session.commit()
@@ -94,6 +121,9 @@ class Clusters(Resource):
         except CreateClusterError as e:
             db.session.rollback()
             api.abort(HTTPStatus.BAD_REQUEST, message=str(e))
+        except ThrottledError as e:
+            db.session.rollback()
+            api.abort(HTTPStatus.TOO_MANY_REQUESTS, message=str(e))
         except SQLAlchemyError as e:
             db.session.rollback()
             api.abort(
@@ -101,20 +131,7 @@ class Clusters(Resource):
                 message="Error inserting the cluster into the db - msg: {}.".format(e),
             )
         else:
-            datadog_metric = cluster.metrics()
-
-            try:
-                metrics.record_count(
-                    name=datadog_metric.metric_name,
-                    increment=1,
-                    tags=datadog_metric.tags,
-                )
-            except MetricsError as e:
-                logger.info(
-                    "Unable to post {} metric with tags {} - msg: {}".format(
-                        datadog_metric.metric_name, datadog_metric.tags, e
-                    )
-                )
+            metrics_sink.record_count(cluster.metrics())
 
         return cluster
 
@@ -125,13 +142,7 @@ class ManageCluster(Resource):
     def get(self, cluster_id: str):
         """Returns information about an ID-specified cluster."""
 
-        cluster = Cluster.query.get(cluster_id)
-        if cluster:
-            return cluster
-        else:
-            api.abort(
-                HTTPStatus.NOT_FOUND, f"Cluster {cluster_id} does not exist in the DB"
-            )
+        return get_or_abort(Cluster, cluster_id)
 
     @login_required
     @api.marshal_list_with(cluster_model, code=HTTPStatus.OK)
@@ -139,22 +150,19 @@ class ManageCluster(Resource):
         """Terminates a cluster in AWS.
         A JSON with the cluster's ID and credentials must be provided as a header."""
 
-        cluster_to_terminate = Cluster.query.get(cluster_id)
+        cluster_to_terminate = get_or_abort(
+            Cluster, cluster_id, options=[undefer_group(PAYLOAD_GROUP)]
+        )
 
-        if not cluster_to_terminate:
-            api.abort(
-                HTTPStatus.NOT_FOUND,
-                f"Cluster {cluster_id} does not exist in the DB",
-            )
         if cluster_to_terminate.user != current_user.get_id():
             api.abort(
                 HTTPStatus.UNAUTHORIZED,
                 f"You are logged in as {current_user.get_id()}. Only {cluster_to_terminate.user} can terminate this cluster.",
             )
 
+        acquire_or_abort(TERMINATE_JOB_FLOWS_BUCKET)
         cluster_to_terminate.terminate()
 
-        db.session.add(cluster_to_terminate)
         db.session.commit()
 
         return cluster_to_terminate
@@ -167,7 +175,7 @@ class ExtendCluster(Resource):
     def put(self, cluster_id: str):
         """Extends a cluster's lifetime for a given amount of minutes."""
 
-        body = request.get_json(force=True)
+        body = get_json_body()
         try:
             extension_minutes = body["minutes"]
         except KeyError:
@@ -176,11 +184,7 @@ class ExtendCluster(Resource):
                 message=f"The received body is different than expected - msg: {e}",
             )
 
-        cluster = Cluster.query.get(cluster_id)
-        if not cluster:
-            api.abort(
-                HTTPStatus.NOT_FOUND, f"Cluster {cluster_id} does not exist in the DB"
-            )
+        cluster = get_or_abort(Cluster, cluster_id)
 
         cluster.terminate_on += timedelta(minutes=extension_minutes)
         db.session.commit()
@@ -194,19 +198,18 @@ class StepInsertion(Resource):
     def post(self, cluster_id: str):
         """Submits a step to be inserted into the specified cluster."""
 
-        cluster = Cluster.query.get(cluster_id)
-        if not cluster:
-            api.abort(
-                HTTPStatus.NOT_FOUND, f"Cluster {cluster_id} does not exist in the DB"
-            )
+        cluster = get_or_abort(
+            Cluster, cluster_id, options=[undefer_group(PAYLOAD_GROUP)]
+        )
 
         # TODO: validate input
-        step_definition = request.get_json(force=True)
+        step_definition = get_json_body()
         step_definition["job_flow_config"] = cluster.job_flow_config
         del step_definition["cluster_config"]
 
         try:
             step = Step(**step_definition)
+            acquire_or_abort(ADD_JOB_FLOW_STEPS_BUCKET)
             cluster_id, step_id = cluster.add_step(step)
             step.check_in(cluster_id, step_id)
             db.session.add(step)
@@ -225,6 +228,10 @@ class StepInsertion(Resource):
             db.session.rollback()
             api.abort(HTTPStatus.BAD_REQUEST, message=str(e))
 
+        except ThrottledError as e:
+            db.session.rollback()
+            api.abort(HTTPStatus.TOO_MANY_REQUESTS, message=str(e))
+
         except UnableToAssignStepError as e:
             api.abort(
                 HTTPStatus.INTERNAL_SERVER_ERROR,
@@ -240,19 +247,6 @@ class StepInsertion(Resource):
                 message="Error inserting the step into the db - msg: {}.".format(e),
             )
         else:
-            datadog_metric = step.metrics()
-
-            try:
-                metrics.record_count(
-                    name=datadog_metric.metric_name,
-                    increment=1,
-                    tags=datadog_metric.tags,
-                )
-            except MetricsError as e:
-                logger.info(
-                    "Unable to post {} metric with tags {} - msg: {}".format(
-                        datadog_metric.metric_name, datadog_metric.tags, e
-                    )
-                )
+            metrics_sink.record_count(step.metrics())
 
         return step
@@ -1,8 +1,8 @@
 from http import HTTPStatus
 from typing import List, Union, Callable
 
-from app.apis.schemas import BigQueueBodySchema, FuryJobBodySchema
-from app.core import Manager
+from app.apis.schemas import bigq_steps_schema, fury_schema
+from app.core import manager_scheduler
 from app.core.errors import ParseBodyError
 
 from flask import request
@@ -16,14 +16,16 @@ api = Namespace("Manager", description="Spark steps manager endpoint")
 @api.route("/")
 class ClusterManager(Resource):
     def post(self):
-        body = request.get_json()
+        body = request.get_json(silent=True)
+        # Fury jobs may call this endpoint without a body, but any body must be JSON.
+        if body is None and request.content_length:
+            api.abort(HTTPStatus.BAD_REQUEST, message="The request body must be JSON")
 
         steps = get_steps_from_body(body)
 
-        with Manager(step_ids=steps) as manager:
-            manager.run()
+        manager_scheduler.schedule(step_ids=steps)
 
-        return HTTPStatus.NO_CONTENT
+        return "", HTTPStatus.ACCEPTED
 
 
 def get_steps_from_body(body) -> Union[List[int], None]:
@@ -77,7 +79,7 @@ def _get_none_from_fury_job_body(body: dict) -> None:
     validation succeeds.
     """
     try:
-        FuryJobBodySchema().validate(body)
+        fury_schema.validate(body)
         return None
 
     except ValidationError as e:
@@ -94,7 +96,7 @@ def _get_steps_from_bigq_body(body: dict) -> List[int]:
         List[int]: list of step id's
     """
     try:
-        bigq_message = BigQueueBodySchema().load(body)
+        bigq_message = bigq_steps_schema.load(body)
         return bigq_message["msg"]["steps"]
 
     except ValidationError as e:
@@ -2,6 +2,7 @@ from http import HTTPStatus
 
 from app.extensions import db
 from app.core.models import StepsCluster
+from app.apis.v1.utils import get_or_abort, query_filters
 
 from flask import request
 from flask_login import login_required
@@ -10,6 +11,8 @@ from flask_restx import Namespace, Resource, fields
 
 api = Namespace("Step Clusters", description="CRUD for step assigned clusters")
 
+STEPS_CLUSTER_FILTER_COLUMNS = {"id", "status"}
+
 steps_cluster_model = api.model(
     "Steps Cluster",
     {
@@ -34,7 +37,8 @@ class Clusters(Resource):
     def get(self):
         """Queries the API DB for all clusters and returns information about them."""
 
-        clusters = StepsCluster.query.filter_by(**request.args).all()
+        filters = query_filters(request.args, STEPS_CLUSTER_FILTER_COLUMNS)
+        clusters = StepsCluster.query.filter_by(**filters).all()
 
         return clusters
 
@@ -45,10 +49,4 @@ class ManageCluster(Resource):
     def get(self, cluster_id: str):
         """Returns information about an ID-specified cluster."""
 
-        cluster = StepsCluster.query.get(cluster_id)
-        if not cluster:
-            api.abort(
-                HTTPStatus.NOT_FOUND, f"Cluster {cluster_id} does not exist in the DB"
-            )
-
-        return cluster
+        return get_or_abort(StepsCluster, cluster_id)
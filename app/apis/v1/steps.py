@@ -1,23 +1,37 @@
 from http import HTTPStatus
 
+from app import metrics_sink
 from app.extensions import db
-from app.notifications import steps_producer
-from app.utils import logger
-from app.core.models import Step
-from app.core.errors import StepCreationError
-from app.apis.v1.utils import generate_config
+from app.core import CANCEL_STEPS_BUCKET
+from app.core.models import PAYLOAD_GROUP, Step
+from app.core.errors import StepCreationError, ThrottledError
+from app.apis.v1.utils import (
+    acquire_or_abort,
+    generate_config,
+    get_json_body,
+    get_or_abort,
+    PAGINATION_PARAMS,
+    paginate,
+    query_filters,
+    stream_marshalled,
+)
 
 from flask import request
 from flask_login import login_required, current_user
 from flask_restx import Namespace, Resource, fields
-from melitk import metrics
-from melitk.bigqueue.exceptions import BigQueueInternalError, InvalidMessageError
-from melitk.metrics.exceptions import MetricsError
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import selectinload, undefer_group
 
 
 api = Namespace("Steps", description="Spark Steps CRUD")
 
+STEP_FILTER_COLUMNS = {"id", "name", "step_id", "status", "cluster_id", "user"}
+
+# Loads the cluster each step was assigned to, which its `logs_uri` is built from.
+# Only for fully fetched queries, not `yield_per` ones: the loaders' SELECTs would run
+# on the connection of the still open, unbuffered cursor and truncate its results.
+LOAD_ASSIGNED_CLUSTER = (selectinload(Step.steps_cluster), selectinload(Step.cluster))
+
 step_model = api.model(
     "Step",
     {
@@ -51,14 +65,13 @@ class Steps(Resource):
         # TODO: validate input
         # Validation should include checking for cluster_config if
         # job_flow_config is not provided
-        step_definition = request.get_json(force=True)
+        step_definition = get_json_body()
 
         job_flow_config = generate_config(step_definition["cluster_config"])
         del step_definition["cluster_config"]
         step_definition["job_flow_config"] = job_flow_config
 
         try:
-            print(step_definition)
             step = Step(**step_definition)
             db.session.add(step)
             db.session.commit()
@@ -81,36 +94,35 @@ class Steps(Resource):
                 message="Error inserting the step into the db - msg: {}.".format(e),
             )
         else:
-            datadog_metric = step.metrics()
-
-            try:
-                metrics.record_count(
-                    name=datadog_metric.metric_name,
-                    increment=1,
-                    tags=datadog_metric.tags,
-                )
-            except MetricsError as e:
-                logger.info(
-                    "Unable to post {} metric with tags {} - msg: {}".format(
-                        datadog_metric.metric_name, datadog_metric.tags, e
-                    )
-                )
+            metrics_sink.record_count(step.metrics())
 
         # TODO: publish is disabled because it results in multiple steps added to the same WAITING cluster
+        # from app.notifications import steps_producer
+        # from melitk.bigqueue.exceptions import (
+        #     BigQueueInternalError,
+        #     InvalidMessageError,
+        # )
+        #
         # try:
-        #     steps_producer.publish(message={"steps": [step.id]})
+        #     steps_producer().publish(message={"steps": [step.id]})
         # except (InvalidMessageError, BigQueueInternalError) as e:
         #     api.abort(HTTPStatus.INTERNAL_SERVER_ERROR, e)
 
         return step
 
-    @api.marshal_list_with(step_model, code=HTTPStatus.OK)
+    @api.doc(params=PAGINATION_PARAMS)
+    @api.response(HTTPStatus.OK, "Success", [step_model])
     def get(self):
         """Queries the API DB for all steps and returns information about them."""
 
-        steps = Step.query.filter_by(**request.args).all()
+        filters = query_filters(request.args, STEP_FILTER_COLUMNS)
+        steps = paginate(
+            Step.query.options(*LOAD_ASSIGNED_CLUSTER).filter_by(**filters),
+            request.args,
+            order_by=Step.id,
+        )
 
-        return steps
+        return stream_marshalled(steps, step_model)
 
 
 @api.route("/<int:step_id>")
@@ -119,11 +131,7 @@ class ManageStep(Resource):
     def get(self, step_id: int):
         """Returns information about an ID-specified step."""
 
-        step = Step.query.get(step_id)
-        if step:
-            return step
-        else:
-            api.abort(HTTPStatus.NOT_FOUND, f"Step {step_id} does not exist in the DB")
+        return get_or_abort(Step, step_id, options=LOAD_ASSIGNED_CLUSTER)
 
     @login_required
     @api.marshal_with(step_model, code=HTTPStatus.OK)
@@ -131,12 +139,11 @@ class ManageStep(Resource):
         """Updates fields from a step.
         A JSON with fields to be modified and its values must be provided as a header."""
 
-        body = request.get_json(force=True)
-        step_to_update = Step.query.get(step_id)
+        body = get_json_body()
+        step_to_update = get_or_abort(Step, step_id, options=LOAD_ASSIGNED_CLUSTER)
         for key in body:
             setattr(step_to_update, key, body[key])
 
-        db.session.add(step_to_update)
         db.session.commit()
 
         return step_to_update
@@ -147,19 +154,24 @@ class ManageStep(Resource):
         """Cancels the step's execution.
         A JSON with credentials must be provided as a header."""
 
-        step_to_cancel = Step.query.get(step_id)
+        step_to_cancel = get_or_abort(
+            Step,
+            step_id,
+            options=[*LOAD_ASSIGNED_CLUSTER, undefer_group(PAYLOAD_GROUP)],
+        )
 
-        if not step_to_cancel:
-            api.abort(HTTPStatus.NOT_FOUND, f"Step {step_id} does not exist in the DB")
         if step_to_cancel.user != current_user.get_id():
             api.abort(
                 HTTPStatus.UNAUTHORIZED,
                 f"You are logged in as {current_user.get_id()}. Only {cluster_to_terminate.user} can cancel this step.",
             )
 
-        step_to_cancel.cancel()
+        acquire_or_abort(CANCEL_STEPS_BUCKET)
+        try:
+            step_to_cancel.cancel()
+        except ThrottledError as e:
+            api.abort(HTTPStatus.TOO_MANY_REQUESTS, message=str(e))
 
-        db.session.add(step_to_cancel)
         db.session.commit()
 
         return step_to_cancel
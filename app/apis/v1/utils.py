@@ -1,10 +1,146 @@
+from app.extensions import db
 from app.core.models import ClusterConfiguration
+from app.serializers import dumps
 
-from flask_restx import abort
+from flask import Response, request, stream_with_context
+from flask_restx import abort, marshal
 from sqlalchemy.orm.exc import NoResultFound
 from http import HTTPStatus
 
 
+PAGINATION_PARAMS = {
+    "limit": "Maximum number of results to return",
+    "offset": "Number of results to skip",
+}
+PAGINATION_ARGS = set(PAGINATION_PARAMS)
+
+
+def get_or_abort(model, primary_key, options=()):
+    """
+    Returns the `model` instance identified by `primary_key` or aborts
+    the request with NOT_FOUND if it does not exist in the DB.
+    Loader `options` (e.g. `undefer_group`) are applied to the query.
+    """
+    instance = db.session.get(model, primary_key, options=options)
+    if instance is None:
+        abort(
+            HTTPStatus.NOT_FOUND,
+            f"{model.__name__} {primary_key} does not exist in the DB",
+        )
+    return instance
+
+
+def acquire_or_abort(bucket):
+    """
+    Takes a token from the AWS API `bucket` or aborts the request with
+    TOO_MANY_REQUESTS if it's empty, instead of making the client wait.
+    """
+    if not bucket.try_acquire():
+        abort(
+            HTTPStatus.TOO_MANY_REQUESTS,
+            message="Too many requests to AWS, please retry later",
+        )
+
+
+def get_json_body():
+    """Returns the JSON body of the current request, aborting if it doesn't have one."""
+    body = request.get_json(silent=True)
+    if body is None:
+        abort(
+            HTTPStatus.BAD_REQUEST,
+            message="The request must have a JSON body "
+            "with the 'Content-Type: application/json' header",
+        )
+    return body
+
+
+def query_filters(args: dict, filterable_columns: set) -> dict:
+    """
+    Validates the query args received in a list request against the
+    columns that can be used to filter the model's query.
+
+    Returns:
+        dict: the filters to be passed to `filter_by`.
+    """
+    filters = {key: args[key] for key in args if key not in PAGINATION_ARGS}
+    for key in filters:
+        if key not in filterable_columns:
+            abort(
+                HTTPStatus.BAD_REQUEST,
+                message=f"{key} is not a filterable field. "
+                f"Accepted fields are: {', '.join(sorted(filterable_columns))}",
+            )
+
+    return filters
+
+
+def paginate(query, args: dict, order_by):
+    """
+    Applies the `limit` and `offset` query args, if received, to `query`.
+    Rows are sorted by `order_by` (the model's primary key), so that pages
+    neither overlap nor skip rows.
+    """
+    try:
+        limit = int(args["limit"]) if "limit" in args else None
+        offset = int(args["offset"]) if "offset" in args else None
+    except ValueError:
+        abort(
+            HTTPStatus.BAD_REQUEST, message="'limit' and 'offset' must be integers"
+        )
+    if (limit is not None and limit < 0) or (offset is not None and offset < 0):
+        abort(
+            HTTPStatus.BAD_REQUEST,
+            message="'limit' and 'offset' must not be negative",
+        )
+
+    return query.order_by(order_by).limit(limit).offset(offset)
+
+
+def stream_marshalled(query, model) -> Response:
+    """
+    Marshals the rows returned by `query` with `model` and streams them
+    as a JSON list, without building the whole response in memory.
+
+    Rows are fetched before streaming: reading them while the response is
+    being sent would keep an unbuffered cursor open, and the queries run by
+    eager loaders on the same connection would discard its remaining rows.
+    """
+    rows = query.all()
+
+    def generate():
+        yield b"["
+        for index, row in enumerate(rows):
+            if index:
+                yield b","
+            yield dumps(marshal(row, model))
+        yield b"]"
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
+
+def _set_instance_type(job_flow_config: dict, value) -> None:
+    job_flow_config["Instances"]["InstanceGroups"][1]["InstanceType"] = value
+
+
+def _set_instance_count(job_flow_config: dict, value) -> None:
+    job_flow_config["Instances"]["InstanceGroups"][1]["InstanceCount"] = value
+
+
+def _set_volume_size(job_flow_config: dict, value) -> None:
+    for instance_group in job_flow_config["Instances"]["InstanceGroups"][:2]:
+        instance_group["EbsConfiguration"]["EbsBlockDeviceConfigs"][0][
+            "VolumeSpecification"
+        ]["SizeInGB"] = value
+
+
+# Functions applying each customizable parameter to a job_flow_config.
+_CUSTOMIZERS = {
+    "instance_type": _set_instance_type,
+    "instance_count": _set_instance_count,
+    "volume_size": _set_volume_size,
+}
+
+
 def generate_config(cluster_config: dict) -> dict:
     """
     Parses the provided 'cluster_config' field in the
@@ -64,31 +200,16 @@ def generate_config(cluster_config: dict) -> dict:
 
     # Applies the requested customizations to the base config.
     if customizations:
-        CUSTOMIZABLE_PARAMETERS = {"instance_type", "instance_count", "volume_size"}
         for key, value in customizations.items():
-            if key not in CUSTOMIZABLE_PARAMETERS:
+            customizer = _CUSTOMIZERS.get(key)
+            if customizer is None:
                 abort(
                     HTTPStatus.BAD_REQUEST,
                     message=f"{key} is not a customizable parameter. "
-                    f"Accepted parameters are: {', '.join(CUSTOMIZABLE_PARAMETERS)}",
+                    f"Accepted parameters are: {', '.join(_CUSTOMIZERS)}",
                 )
 
-            if value and key == "instance_type":
-                job_flow_config["Instances"]["InstanceGroups"][1][
-                    "InstanceType"
-                ] = value
-
-            if value and key == "instance_count":
-                job_flow_config["Instances"]["InstanceGroups"][1][
-                    "InstanceCount"
-                ] = value
-
-            if value and key == "volume_size":
-                job_flow_config["Instances"]["InstanceGroups"][0]["EbsConfiguration"][
-                    "EbsBlockDeviceConfigs"
-                ][0]["VolumeSpecification"]["SizeInGB"] = value
-                job_flow_config["Instances"]["InstanceGroups"][1]["EbsConfiguration"][
-                    "EbsBlockDeviceConfigs"
-                ][0]["VolumeSpecification"]["SizeInGB"] = value
+            if value:
+                customizer(job_flow_config, value)
 
     return job_flow_config
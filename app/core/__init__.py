@@ -1,123 +1,254 @@
 import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from threading import Thread
-from typing import List
-from collections import namedtuple
+from functools import partial
+from threading import Lock
+from typing import List, Optional
 
-from app.core.models import Cluster, StepsCluster, Step
+from app.core.models import Cluster, PAYLOAD_GROUP, StepsCluster, Step
 from app.core.errors import (
-    UpdateStatusError,
-    UnableToTerminateClusterError,
     CreateClusterError,
+    ThrottledError,
     UnableToAssignStepError,
 )
+from app import metrics_sink
 from app.extensions import db
 from app.utils import logger
 
 from flask import current_app
-from sqlalchemy import and_
-from melitk import metrics
-from melitk.metrics.exceptions import MetricsError
+from sqlalchemy.orm import undefer_group
 
 
-class FlaskThread(Thread):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.app = current_app._get_current_object()
+def _run_in_app_context(app, function):
+    """Runs `function` within an app context of `app`, from a worker thread."""
+    with app.app_context():
+        try:
+            return function()
+        finally:
+            # Return the thread's connection to the pool.
+            db.session.remove()
 
-    def run(self):
-        with self.app.app_context():
-            super().run()
+
+class ManagerScheduler:
+    """
+    Runs the `Manager` in a background thread, one run at a time.
+
+    Runs requested while another one is still waiting to start are merged into it,
+    so a burst of /manage requests results in at most one run in progress and one
+    pending run that manages all the requested steps.
+    """
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._lock = Lock()
+        self._pending_run = False
+        self._pending_step_ids = set()
+        self._pending_all_steps = False
+
+    def schedule(self, step_ids: List[int] = None) -> None:
+        """Schedules a `Manager` run for the given steps without blocking the caller."""
+        with self._lock:
+            if step_ids:
+                self._pending_step_ids.update(step_ids)
+            else:
+                # No step IDs means that every unassigned step must be managed.
+                self._pending_all_steps = True
+
+            if self._pending_run:
+                return
+            self._pending_run = True
+
+        self._executor.submit(self._run, current_app._get_current_object())
+
+    def _run(self, app) -> None:
+        with self._lock:
+            step_ids = None if self._pending_all_steps else list(self._pending_step_ids)
+            self._pending_step_ids.clear()
+            self._pending_all_steps = False
+            self._pending_run = False
+
+        with app.app_context():
+            try:
+                with Manager(step_ids=step_ids) as manager:
+                    manager.run()
+            except Exception as e:
+                # Nobody is waiting for this result, so errors must be logged here.
+                logger.error(
+                    "Error running manager for steps %s - msg: %s", step_ids, e
+                )
+
+
+manager_scheduler = ManagerScheduler()
 
 
 """
 Based on: https://docs.aws.amazon.com/general/latest/gr/emr.html
 There is a common issue when using some AWS APIs. Whenever you exceed some requests
-frequency, a `ThrottlingException` is raised. To avoid it, we'll set some limits
-and sleeps.
+frequency, a `ThrottlingException` is raised. To avoid it, every call to those APIs
+takes a token from the bucket of its API. The manager waits for one when the bucket
+is empty, while API requests fail fast instead of sleeping inside the request.
 """
 
-emr_quota_bucket = namedtuple("emr_quota_bucket", "maximum_capacity refill_rate")
+
+class TokenBucket:
+    """
+    Thread-safe token bucket holding up to `capacity` tokens, which are refilled
+    at `refill_rate` tokens per second.
+    """
+
+    def __init__(self, capacity: float, refill_rate: float):
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.tokens = float(capacity)
+        self.last_refill = time.monotonic()
+        self._lock = Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity,
+            self.tokens + (now - self.last_refill) * self.refill_rate,
+        )
+        self.last_refill = now
+
+    def acquire(self) -> float:
+        """
+        Takes a token from the bucket, sleeping until it's available if the bucket
+        is empty.
+
+        Returns:
+            float: seconds slept waiting for the token.
+        """
+        with self._lock:
+            self._refill()
+
+            # The token is taken even if it isn't available yet, so that concurrent
+            # callers wait for consecutive tokens instead of competing for the same one.
+            self.tokens -= 1
+            sleep_time = max(0.0, -self.tokens / self.refill_rate)
+
+        if sleep_time:
+            time.sleep(sleep_time)
+        return sleep_time
+
+    def try_acquire(self) -> bool:
+        """
+        Takes a token from the bucket only if one is available right now.
+
+        Returns:
+            bool: whether the token was taken.
+        """
+        with self._lock:
+            self._refill()
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
 
 FREQUENCY_LIMIT_COEFFICIENT = 1
 
-# Following constants represent max request per second
+# Following buckets refill rates represent max request per second
 
-MAX_RUN_JOB_FLOW_FREQUENCY = emr_quota_bucket(
+RUN_JOB_FLOW_BUCKET = TokenBucket(
     10 * FREQUENCY_LIMIT_COEFFICIENT, 0.5
 )  # To create clusters
-MAX_ADD_JOB_FLOW_STEPS_FREQUENCY = emr_quota_bucket(
+ADD_JOB_FLOW_STEPS_BUCKET = TokenBucket(
     10 * FREQUENCY_LIMIT_COEFFICIENT, 0.5
 )  # To add steps
-MAX_DESCRIBE_CLUSTER_FREQUENCY = emr_quota_bucket(
+DESCRIBE_CLUSTER_BUCKET = TokenBucket(
     10 * FREQUENCY_LIMIT_COEFFICIENT, 1.0
 )  # To retrieve clusters status
-MAX_TERMINATE_JOB_FLOWS_FREQUENCY = emr_quota_bucket(
+TERMINATE_JOB_FLOWS_BUCKET = TokenBucket(
     10 * FREQUENCY_LIMIT_COEFFICIENT, 0.5
 )  # To terminate clusters
-MAX_CANCEL_STEPS_FREQUENCY = emr_quota_bucket(
+CANCEL_STEPS_BUCKET = TokenBucket(
     10 * FREQUENCY_LIMIT_COEFFICIENT, 0.2
 )  # To cancel steps. TODO: not listed in the docs
-MAX_DESCRIBE_STEP_FREQUENCY = emr_quota_bucket(
+DESCRIBE_STEP_BUCKET = TokenBucket(
     10 * FREQUENCY_LIMIT_COEFFICIENT, 0.5
 )  # To retrieve step status
 
 
-def update_clusters():
-    """Updates cluster's status prior to define which steps should be launched."""
+# Describe calls are I/O bound, so they are sent concurrently. The token buckets
+# still limit how many of them are sent per second.
+UPDATE_STATUS_WORKERS = 10
 
-    clusters_to_update = Cluster.query.filter(
-        ~Cluster.status.in_(Cluster.TERMINATED_STATUS)
-    ).all()
 
-    clusters_to_update += StepsCluster.query.filter(
-        ~StepsCluster.status.in_(Cluster.TERMINATED_STATUS)
-    ).all()
+def _fetch_new_states(batch: list, model, bucket: TokenBucket) -> List[dict]:
+    """Retrieves the new states of a batch of clusters or steps from EMR."""
+    logger.debug("Updating %s %s", model.__name__, [target.id for target in batch])
+    bucket.acquire()
+    return model.fetch_new_states(batch)
 
-    for index, cluster in enumerate(clusters_to_update):
-        try:
-            logger.debug("Updating cluster {}".format(cluster.id))
-            cluster.update_status()
-            logger.debug("Updated cluster {}".format(cluster.id))
-            sleep_for_service_quota(MAX_DESCRIBE_CLUSTER_FREQUENCY, index)
-        except UpdateStatusError:
-            pass
+
+def _update_statuses(model, resources: list, bucket: TokenBucket) -> None:
+    """
+    Retrieves the states of the resources concurrently, in the batches defined by
+    their model, and then applies them with one bulk UPDATE.
+
+    The batches only hold plain values taken from the resources in this thread:
+    the worker threads must not touch the session's instances, whose attribute
+    access could load data through it.
+    """
+    batches = model.status_batches(resources)
+    fetch_new_states = partial(_fetch_new_states, model=model, bucket=bucket)
+    with ThreadPoolExecutor(max_workers=UPDATE_STATUS_WORKERS) as executor:
+        results = executor.map(fetch_new_states, batches)
+        states = [state for batch_states in results for state in batch_states]
+
+    model.bulk_apply_states(db.session, states)
+
+
+def update_clusters():
+    """Updates cluster's status prior to define which steps should be launched."""
+
+    # EMR can only describe clusters one at a time: ListClusters can't filter by ID
+    # and its summaries lack the fields kept in the snapshot.
+    for model in (Cluster, StepsCluster):
+        clusters_to_update = (
+            model.query.options(undefer_group(PAYLOAD_GROUP))
+            .filter(model.status.in_(model.ACTIVE_STATUS))
+            .all()
+        )
+        _update_statuses(model, clusters_to_update, DESCRIBE_CLUSTER_BUCKET)
 
     db.session.commit()
 
 
 def update_steps():
     """Updates steps's status prior to define which steps should be launched."""
-    steps_to_update = Step.query.filter(~Step.status.in_(Step.TERMINATED_STATUS))
-    for index, step in enumerate(steps_to_update):
-        try:
-            logger.debug("Updating step {}".format(step.id))
-            step.update_status()
-            logger.debug("Updated step {}".format(step.id))
-            sleep_for_service_quota(MAX_DESCRIBE_STEP_FREQUENCY, index)
-        except UpdateStatusError:
-            pass
+    steps_to_update = (
+        Step.query.options(undefer_group(PAYLOAD_GROUP))
+        .filter(Step.status.in_(Step.ACTIVE_STATUS))
+        .all()
+    )
+
+    # Steps are described in batches, with one ListSteps request per batch.
+    _update_statuses(Step, steps_to_update, DESCRIBE_STEP_BUCKET)
 
     db.session.commit()
 
 
-def sleep_for_service_quota(
-    max_frequency: emr_quota_bucket, bucket_capacity_usage: int
-):
+TERMINATE_WORKERS = 10
+
+
+def _terminate_cluster(cluster_id: str, emr_handler) -> Optional[Exception]:
     """
-    Function to calculate the sleep time that should apply according to the `max_frequency` of each
-    AWS function and its `max_frequency`
-    Args:
-        max_frequency (emr_quota_bucket): max frequency for the used AWS function
-        bucket_capacity_usage (int): number of request to the AWS service
+    Terminates a cluster in EMR. Runs in a worker thread, so it receives plain
+    values instead of the cluster, which belongs to the caller's session.
+
     Returns:
-        float: sleep time required to avoid a `ThrottlingException`
+        Exception: the error raised terminating the cluster, if any.
     """
-    if bucket_capacity_usage < max_frequency.maximum_capacity:
-        return 0
-
-    sleep_time = float(1 / max_frequency.refill_rate) * FREQUENCY_LIMIT_COEFFICIENT
-    time.sleep(sleep_time)
+    try:
+        TERMINATE_JOB_FLOWS_BUCKET.acquire()
+        logger.info("Terminating cluster %s", cluster_id)
+        emr_handler.terminate_cluster(cluster_id=cluster_id)
+    except Exception as e:
+        return e
+    return None
 
 
 class Manager:
@@ -125,23 +256,35 @@ class Manager:
         # Step IDs to be managed
         self.step_ids = step_ids
 
-    def __enter__(self):
-        t_update_clusters = FlaskThread(target=update_clusters)
-        t_update_steps = FlaskThread(target=update_steps)
-
-        t_update_clusters.start()
-        t_update_steps.start()
+    # Runs the cluster and step updates concurrently. Shared between runs, so that
+    # its threads are reused.
+    _updates_executor = ThreadPoolExecutor(max_workers=2)
 
-        t_update_clusters.join()
-        t_update_steps.join()
-
-        self.unassigned_steps = self._unassigned_steps().with_for_update().all()
+    def __enter__(self):
+        app = current_app._get_current_object()
+        updates = {
+            self._updates_executor.submit(_run_in_app_context, app, update): update
+            for update in (update_clusters, update_steps)
+        }
+
+        for future, update in updates.items():
+            error = future.exception()
+            if error is not None:
+                # A failed update doesn't prevent managing the steps.
+                logger.error("Error running %s - msg: %s", update.__name__, error)
+
+        # Only their IDs are loaded: each step is locked right before it's managed.
+        self.unassigned_step_ids = [
+            step_id for step_id, in self._unassigned_steps().with_entities(Step.id)
+        ]
 
         # If with_for_update() is added to waiting_step_clusters,
         # many clusters are instantiated for the same step.
-        self.waiting_step_clusters = StepsCluster.query.filter_by(
-            status=Cluster.UNASSIGNED_STATUS
-        ).all()
+        self.waiting_step_clusters = (
+            StepsCluster.query.options(undefer_group(PAYLOAD_GROUP))
+            .filter_by(status=Cluster.UNASSIGNED_STATUS)
+            .all()
+        )
 
         return self
 
@@ -155,29 +298,64 @@ class Manager:
 
         return unassigned_steps
 
+    def _lock_unassigned_step(self, step_id: int) -> Optional[Step]:
+        """
+        Locks the step with SELECT ... FOR UPDATE until the next commit, and returns
+        it only if it's still unassigned.
+
+        Every gunicorn worker runs its own manager. Once a manager has added a step to
+        a cluster, it commits the step's new status, which releases the lock, so any
+        other manager waiting on it will find that the step was already assigned.
+        """
+        return (
+            self._unassigned_steps()
+            .options(undefer_group(PAYLOAD_GROUP))
+            .filter(Step.id == step_id)
+            .with_for_update()
+            .one_or_none()
+        )
+
     def run(self):
+        """
+        Assigns the unassigned steps to clusters and terminates the expired ones.
+
+        Changes are committed as soon as they are made in EMR, so that a failure
+        managing a step can't roll back what was already done for the previous ones.
+        """
         categorized_clusters = self.categorize_clusters()
 
-        for index, step in enumerate(self.unassigned_steps):
+        for step_id in self.unassigned_step_ids:
+            step = self._lock_unassigned_step(step_id)
+            if step is None:
+                # Already assigned by another manager since this run started.
+                continue
+
             try:
                 assigned_cluster = self.assign_step_to_cluster(
                     step, categorized_clusters
                 )
-                sleep_for_service_quota(MAX_ADD_JOB_FLOW_STEPS_FREQUENCY, index)
 
-            except (CreateClusterError, UnableToAssignStepError) as e:
+            except ThrottledError as e:
+                # The step is left unassigned, to be managed in a later run.
+                logger.warning("Throttled assigning step %s - msg: %s", step.id, e)
+
+            except (CreateClusterError, UnableToAssignStepError):
                 # CreateClusterError: This error is raised if the job_flow_config provided is rejected by aws.
                 # UnableToAssignStepError: This error is raised if AWS is unable to insert the step into a cluster.
-                logger.error(e)
+                logger.exception("Error assigning step %s", step.id)
                 step.status = "BAD_CONFIG"
 
-            except Exception as e:
+            except Exception:
                 # Catch all exceptions when inserting so that BigQ doesn't endlessly POST to /manage.
-                logger.error(e)
+                logger.exception("Error assigning step %s", step.id)
+                # A failed flush leaves the session unusable until it's rolled back.
+                # What was done in EMR for this step has already been committed.
+                db.session.rollback()
                 step.status = "ERROR"
 
-        self.terminate_clusters()
+            db.session.commit()
 
+        self.terminate_clusters()
         db.session.commit()
 
     def categorize_clusters(self) -> dict:
@@ -191,14 +369,9 @@ class Manager:
             dict. a dictionary where each key is a Cluster's configuration hash value, and the value
         is the list of clusters available with that same configuration.
         """
-        categorized_clusters = {}
+        categorized_clusters = defaultdict(list)
         for cluster in self.waiting_step_clusters:
-            try:
-                matching_clusters = categorized_clusters[hash(cluster)]
-                matching_clusters.append(cluster)
-                categorized_clusters[hash(cluster)] = matching_clusters
-            except KeyError:
-                categorized_clusters[hash(cluster)] = [cluster]
+            categorized_clusters[cluster.config_key].append(cluster)
 
         return categorized_clusters
 
@@ -216,25 +389,22 @@ class Manager:
         """
         viable_cluster = self.get_viable_cluster(step, categorized_clusters)
 
-        cluster_id, step_id = viable_cluster.add_step(step)
-        step.check_in(cluster_id, step_id)
-
-        datadog_metric = viable_cluster.metrics()
+        ADD_JOB_FLOW_STEPS_BUCKET.acquire()
         try:
-            metrics.record_count(
-                name=datadog_metric.metric_name, increment=1, tags=datadog_metric.tags
-            )
-        except MetricsError as e:
-            logger.info(
-                "Unable to post {} metric with tags {} - msg: {}".format(
-                    datadog_metric.metric_name, datadog_metric.tags, e
-                )
-            )
-
-        db.session.add(viable_cluster)
-        db.session.add(step)
+            cluster_id, step_id = viable_cluster.add_step(step)
+        except ThrottledError:
+            # The cluster is still free, so it's given back for the next steps with
+            # the same config, instead of creating new clusters for them.
+            categorized_clusters[step.config_key].insert(0, viable_cluster)
+            raise
+        step.check_in(cluster_id, step_id)
+        # The step is already running in EMR, so it must not be managed again even
+        # if something fails afterwards.
         db.session.commit()
 
+        # Posted from the metrics sink's thread, without blocking the run.
+        metrics_sink.record_count(viable_cluster.metrics())
+
         return viable_cluster
 
     def get_viable_cluster(self, step, categorized_clusters: dict) -> StepsCluster:
@@ -252,29 +422,51 @@ class Manager:
             StepsCluster: to be used to execute the step.
 
         """
-        viable_clusters = categorized_clusters.get(hash(step))
+        viable_clusters = categorized_clusters.get(step.config_key)
         if viable_clusters:
             return viable_clusters.pop(0)
 
         cluster = StepsCluster(
             credentials=step.credentials, job_flow_config=step.job_flow_config
         )
+        RUN_JOB_FLOW_BUCKET.acquire()
         cluster.create()
+        # The cluster already exists in EMR, so it's stored right away, even if the
+        # step can't be added to it.
+        db.session.add(cluster)
         db.session.commit()
         return cluster
 
     def terminate_clusters(self) -> None:
         """
-        Terminates received clusters.
+        Terminates the expired clusters. Terminations are I/O bound, so they are sent
+        concurrently.
 
         Raises:
             Passes exception to avoid stopping the flow for single errors.
 
         """
-        for cluster in self.expired_clusters():
+        expired_clusters = self.expired_clusters()
+        if not expired_clusters:
+            return
+
+        cluster_ids = [cluster.id for cluster in expired_clusters]
+        emr_handlers = [cluster.emr_handler for cluster in expired_clusters]
+        with ThreadPoolExecutor(max_workers=TERMINATE_WORKERS) as executor:
+            errors = list(executor.map(_terminate_cluster, cluster_ids, emr_handlers))
+
+        # Statuses are only set here, in the thread which owns the session.
+        for cluster, error in zip(expired_clusters, errors):
             try:
-                cluster.terminate()
-            except UnableToTerminateClusterError:
+                cluster.apply_termination(error)
+            except ThrottledError as e:
+                # Left as it was, to be terminated in a later run.
+                logger.warning(
+                    "Throttled terminating cluster %s - msg: %s", cluster.id, e
+                )
+            except Exception:
+                # Already logged by `status_handler`, which also set the status.
+                # The other clusters' statuses must still be set.
                 pass
 
     def expired_clusters(self) -> List[StepsCluster]:
@@ -283,30 +475,15 @@ class Manager:
 
         now_date = datetime.utcnow()
 
-        expired_step_clusters = (
-            StepsCluster.query.filter(
-                and_(
-                    ~StepsCluster.status.in_(StepsCluster.TERMINATED_STATUS),
-                    StepsCluster.terminate_on != None,
-                    # read this as: terminate_on is older than now.
-                    StepsCluster.terminate_on < now_date,
-                )
+        # Clusters and StepsClusters are concrete tables, so they can't be locked
+        # with a single SELECT ... FOR UPDATE.
+        expired_clusters = []
+        for model in (StepsCluster, Cluster):
+            expired_clusters += (
+                model.query.options(undefer_group(PAYLOAD_GROUP))
+                .filter(model.expired_filter(now_date))
+                .with_for_update()
+                .all()
             )
-            .with_for_update()
-            .all()
-        )
-
-        expired_clusters = (
-            Cluster.query.filter(
-                and_(
-                    ~Cluster.status.in_(Cluster.TERMINATED_STATUS),
-                    Cluster.terminate_on != None,
-                    # read this as: terminate_on is older than now.
-                    Cluster.terminate_on < now_date,
-                )
-            )
-            .with_for_update()
-            .all()
-        )
 
-        return expired_step_clusters + expired_clusters
+        return expired_clusters
@@ -1,4 +1,9 @@
-from urllib.parse import urlparse
+import random
+import time
+from functools import lru_cache, wraps
+from io import BytesIO
+from threading import Lock
+from typing import List, Optional
 
 from app.utils import logger
 from app.core.errors import (
@@ -7,19 +12,77 @@ from app.core.errors import (
     UnableToAssignStepError,
     UpdateStatusError,
     StepCancelError,
+    ThrottledError,
     UnableToTerminateClusterError,
     UnableToUploadContentError,
 )
 
 import boto3
-from botocore.exceptions import ClientError, ParamValidationError
+from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import (
+    ClientError,
+    ConnectionError as BotocoreConnectionError,
+    ParamValidationError,
+)
 
 
 DEFAULT_AWS_REGION = "us-east-1"
 
 DEFAULT_ENCODING = "utf-8"
 
+# Clients are shared between threads, so their connection pool must fit them all.
+# Adaptive retries also rate limit the client when AWS starts throttling it.
+CLIENT_CONFIG = Config(
+    max_pool_connections=50,
+    retries={"max_attempts": 10, "mode": "adaptive"},
+    connect_timeout=3,
+    read_timeout=20,
+)
+
+# EMR calls are retried by `aws_retry`, so botocore doesn't retry them as well.
+# Adaptive mode still rate limits the client when AWS throttles it.
+EMR_CLIENT_CONFIG = CLIENT_CONFIG.merge(
+    Config(retries={"total_max_attempts": 1, "mode": "adaptive"})
+)
+
+SERVICE_CLIENT_CONFIGS = {"emr": EMR_CLIENT_CONFIG}
+
+# Contents smaller than this are uploaded with a single put_object request
+SINGLE_UPLOAD_MAX_SIZE = 1024 * 1024
+
+# Larger contents are uploaded in concurrent parts once they exceed the threshold
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024, max_concurrency=10, use_threads=True
+)
+
+# Error codes returned by AWS when a request is rejected because of its rate
+THROTTLING_ERROR_CODES = frozenset(
+    {
+        "Throttling",
+        "ThrottlingException",
+        "RequestLimitExceeded",
+        "TooManyRequestsException",
+    }
+)
+
+# Error codes for which the request is retried by `aws_retry`. Server errors may
+# happen after the request was applied, so requests which aren't idempotent are
+# only retried when throttled, since throttled requests are rejected before that.
+RETRYABLE_ERROR_CODES = THROTTLING_ERROR_CODES | {
+    "InternalFailure",
+    "InternalServerError",
+    "ServiceUnavailable",
+}
+
+# A single session shares botocore's loaded service models between clients. Creating
+# clients from a session isn't thread-safe, while using them is.
+_session = boto3.session.Session()
+_session_lock = Lock()
 
+
+@lru_cache(maxsize=256)
 def service_client(
     service: str,
     aws_access_key_id: str,
@@ -27,15 +90,103 @@ def service_client(
     aws_session_token: str = None,
     region_name: str = DEFAULT_AWS_REGION,
 ):
-    """Creates the client for the required service with the given credentials."""
+    """
+    Creates the client for the required service with the given credentials.
+    Clients are cached, so that the ones for the same credentials reuse their
+    connections.
+    """
+
+    with _session_lock:
+        return _session.client(
+            service,
+            aws_access_key_id=aws_access_key_id,
+            aws_secret_access_key=aws_secret_access_key,
+            aws_session_token=aws_session_token,
+            region_name=region_name,
+            config=SERVICE_CLIENT_CONFIGS.get(service, CLIENT_CONFIG),
+        )
+
+
+def aws_error(error: Exception) -> Optional[ClientError]:
+    """
+    Returns `error` if it's an error returned by AWS, else the AWS error that caused
+    it (if any).
+    """
+    while error is not None:
+        if isinstance(error, ClientError):
+            return error
+        error = error.__cause__ or error.__context__
+    return None
+
+
+def _is_retryable(error: Exception, retry_on: frozenset) -> bool:
+    """
+    Whether `error`, or the AWS error that caused it, is worth retrying: a
+    `retry_on` error code or a failure to connect to AWS. botocore only raises
+    ConnectionError when it couldn't connect, i.e. when the request wasn't sent,
+    unlike read timeouts or closed connections.
+    """
+    while error is not None:
+        if isinstance(error, ClientError):
+            return error.response.get("Error", {}).get("Code") in retry_on
+        if isinstance(error, BotocoreConnectionError):
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
 
-    return boto3.client(
-        service,
-        aws_access_key_id=aws_access_key_id,
-        aws_secret_access_key=aws_secret_access_key,
-        aws_session_token=aws_session_token,
-        region_name=region_name,
-    )
+def aws_retry(
+    max_attempts: int = 5,
+    base: float = 0.1,
+    cap: float = 5.0,
+    retry_on: frozenset = RETRYABLE_ERROR_CODES,
+):
+    """
+    Retries the decorated method when it fails because of a retryable AWS error,
+    waiting a random time of up to `base * 2 ** attempt` seconds (capped at `cap`)
+    between attempts.
+
+    Args:
+        max_attempts (int): maximum number of calls to the decorated method.
+        base (float): maximum wait after the first attempt, in seconds.
+        cap (float): maximum wait between attempts, in seconds.
+        retry_on (frozenset): AWS error codes that are retried.
+    """
+
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            for attempt in range(max_attempts):
+                try:
+                    return function(*args, **kwargs)
+                except Exception as e:
+                    if attempt + 1 == max_attempts or not _is_retryable(e, retry_on):
+                        raise
+                    sleep_time = random.uniform(0, min(cap, base * 2 ** attempt))
+                    logger.debug(
+                        "Retrying %s in %.2fs - msg: %s",
+                        function.__name__,
+                        sleep_time,
+                        e,
+                    )
+                    time.sleep(sleep_time)
+
+        return wrapper
+
+    return decorator
+
+
+def raise_if_throttled(error: Exception) -> None:
+    """
+    Raises:
+        ThrottledError: if `error` means that AWS throttled the request, even after
+            the client retried it.
+    """
+    if (
+        isinstance(error, ClientError)
+        and error.response.get("Error", {}).get("Code") in THROTTLING_ERROR_CODES
+    ):
+        raise ThrottledError("Request throttled by AWS") from error
 
 
 class AWSHandler:
@@ -86,9 +237,9 @@ class S3Handler(AWSHandler):
             tuple (str, str): (bucket name, key name)
         """
 
-        parsed_s3_uri = urlparse(s3_uri)
-        bucket, key = parsed_s3_uri.netloc, parsed_s3_uri.path.lstrip("/")
-        return bucket, key
+        _, _, path = s3_uri.partition("://")
+        bucket, _, key = path.partition("/")
+        return bucket, key.lstrip("/")
 
     def file_exists(self, destination_uri: str) -> bool:
         """
@@ -126,13 +277,19 @@ class S3Handler(AWSHandler):
             str: the stored content.
 
         Raises:
-            UnableToUploadContentError: when the put_object method from boto3 fails.
+            UnableToUploadContentError: when the upload to s3 fails.
         """
 
         bucket, key = self.split_s3_uri(destination_uri)
+        body = content.encode(DEFAULT_ENCODING)
         try:
-            self.client.put_object(Body=content, Bucket=bucket, Key=key)
-        except ClientError as e:
+            if len(body) < SINGLE_UPLOAD_MAX_SIZE:
+                self.client.put_object(Body=body, Bucket=bucket, Key=key)
+            else:
+                self.client.upload_fileobj(
+                    BytesIO(body), bucket, key, Config=TRANSFER_CONFIG
+                )
+        except (ClientError, S3UploadFailedError) as e:
             raise UnableToUploadContentError(
                 "Unable to upload content - msg: {}".format(e)
             )
@@ -159,6 +316,9 @@ class S3Handler(AWSHandler):
 class EMRHandler(AWSHandler):
     """ Defines methods to interact with AWS' EMR service. """
 
+    # Maximum number of step IDs accepted by ListSteps
+    LIST_STEPS_MAX_IDS = 10
+
     def __init__(
         self,
         aws_access_key_id: str,
@@ -186,15 +346,21 @@ class EMRHandler(AWSHandler):
                 "The emr credentials provided are either invalid or do not have the necessary permissions"
             )
 
+    # RunJobFlow has no idempotency token: retrying it after a server error could
+    # create a second cluster.
+    @aws_retry(retry_on=THROTTLING_ERROR_CODES)
     def create_cluster(self, job_flow_config: dict):
         """ Method to instantiate clusters in AWS' EMR."""
         try:
             response = self.client.run_job_flow(**job_flow_config)
         except (ClientError, ParamValidationError) as e:
-            raise CreateClusterError("Error creating cluster - msg: {}".format(e))
+            raise_if_throttled(e)
+            raise CreateClusterError("Error creating cluster") from e
         cluster_id = response["JobFlowId"]
         return cluster_id
 
+    # Retrying after a server error could add the step twice.
+    @aws_retry(retry_on=THROTTLING_ERROR_CODES)
     def add_step_to_cluster(self, cluster_id: str, step):
         """Method to insert steps into active EMR clusters.
 
@@ -213,15 +379,15 @@ class EMRHandler(AWSHandler):
                 JobFlowId=cluster_id, Steps=[step.step_config]
             )
         except (ClientError, ParamValidationError) as e:
+            raise_if_throttled(e)
             raise UnableToAssignStepError(
-                "Unable to add step {} to cluster {} - msg: {}".format(
-                    step.id, cluster_id, e
-                )
-            )
+                "Unable to add step {} to cluster {}".format(step.id, cluster_id)
+            ) from e
 
         inserted_step_id = response["StepIds"][0]
         return inserted_step_id
 
+    @aws_retry()
     def describe_cluster(self, cluster_id: str):
         """Get cluster's status and timeline from AWS.
 
@@ -237,12 +403,14 @@ class EMRHandler(AWSHandler):
         try:
             response = self.client.describe_cluster(ClusterId=cluster_id)
         except ClientError as e:
+            raise_if_throttled(e)
             raise UpdateStatusError(
-                "Error updating status for cluster {} - msg: {}".format(cluster_id, e)
-            )
+                "Error updating status for cluster {}".format(cluster_id)
+            ) from e
 
         return response
 
+    @aws_retry()
     def terminate_cluster(self, cluster_id: str):
         """Terminates clusters in AWS.
 
@@ -255,10 +423,12 @@ class EMRHandler(AWSHandler):
         try:
             self.client.terminate_job_flows(JobFlowIds=[cluster_id])
         except ClientError as e:
+            raise_if_throttled(e)
             raise UnableToTerminateClusterError(
-                "Error terminating cluster {} - msg: {}".format(cluster_id, e)
-            )
+                "Error terminating cluster {}".format(cluster_id)
+            ) from e
 
+    @aws_retry()
     def cancel_steps(self, cluster_id: str, step_id: str):
         """Cancels steps from running AWS clusters.
 
@@ -272,33 +442,33 @@ class EMRHandler(AWSHandler):
         try:
             response = self.client.cancel_steps(ClusterId=cluster_id, StepIds=[step_id])
         except Exception as e:
+            raise_if_throttled(e)
             raise StepCancelError(
-                "Error cancelling step {} in cluster {} - msg: {}".format(
-                    step_id, cluster_id, e
-                )
-            )
+                "Error cancelling step {} in cluster {}".format(step_id, cluster_id)
+            ) from e
 
         return response
 
-    def describe_step(self, cluster_id: str, step_id: str):
-
-        """Describe a step assigned to a given cluster.
+    @aws_retry()
+    def list_steps(self, cluster_id: str, step_ids: List[str]) -> List[dict]:
+        """Describes up to `LIST_STEPS_MAX_IDS` steps of a cluster with one request.
 
         Args:
-            cluster_id (str): the AWS ID representing the cluster containing the step to be described.
-            step_id (str): the AWS ID representing the step to be described.
+            cluster_id (str): the AWS ID representing the cluster containing the steps.
+            step_ids (list): the AWS IDs representing the steps to be described.
 
         Returns:
-            response (dict).
+            list: the steps' summaries. Steps which weren't found are left out.
 
         Raises:
-            UpdateStatusError: when the client fails to describe the step.
+            UpdateStatusError: when the client fails to list the steps.
         """
         try:
-            response = self.client.describe_step(ClusterId=cluster_id, StepId=step_id)
+            response = self.client.list_steps(ClusterId=cluster_id, StepIds=step_ids)
         except ClientError as e:
+            raise_if_throttled(e)
             raise UpdateStatusError(
-                "Error updating status for step {} - msg: {}".format(step_id, e)
-            )
+                "Error updating status for steps {}".format(step_ids)
+            ) from e
 
-        return response
+        return response["Steps"]
@@ -1,4 +1,17 @@
-class ClusterManagerBaseError(Exception):
+class ChainedError(Exception):
+    """
+    Error whose message includes the one from the error that caused it
+    (`raise ... from cause`). It's only formatted when the error is printed.
+    """
+
+    def __str__(self):
+        message = super().__str__()
+        if self.__cause__ is not None:
+            return "{} - msg: {}".format(message, self.__cause__)
+        return message
+
+
+class ClusterManagerBaseError(ChainedError):
     pass
 
 
@@ -32,7 +45,7 @@ class StepCancelError(StepBaseError):
 # AWS Handler exceptions #
 
 
-class AWSHandlerError(Exception):
+class AWSHandlerError(ChainedError):
     pass
 
 
@@ -44,6 +57,10 @@ class UnableToUploadContentError(AWSHandlerError):
     pass
 
 
+class ThrottledError(AWSHandlerError):
+    pass
+
+
 # Cluster custom exceptions #
 
 
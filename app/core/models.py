@@ -1,10 +1,12 @@
-import json
+import hashlib
 import os
-from collections import OrderedDict
+import re
+from collections import defaultdict, namedtuple
 from datetime import datetime, timedelta
-from functools import wraps
+from functools import lru_cache, wraps
+from typing import List, Optional
 
-from app.core.aws_handler import S3Handler, EMRHandler
+from app.core.aws_handler import aws_error, S3Handler, EMRHandler
 from app.core.errors import (
     CreateClusterError,
     StepCreationError,
@@ -12,14 +14,18 @@ from app.core.errors import (
     UnableToAssignStepError,
     UpdateStatusError,
     StepCancelError,
+    ThrottledError,
     UnableToUploadContentError,
 )
-from app.database import Encrypted
+from app.database import Encrypted, JSONBlob
+from app.serializers import dumps, loads
 from app.extensions import db
 from app.utils import datadog_metric, logger
 
-from sqlalchemy import orm
+from sqlalchemy import and_, orm
+from sqlalchemy.ext.declarative import declared_attr
 from flask_login import current_user
+from werkzeug.utils import cached_property
 
 
 def status_handler(on_error, on_success=None):
@@ -42,11 +48,29 @@ def status_handler(on_error, on_success=None):
         def wrapper(self, *args, **kwargs):
             try:
                 retval = function(self, *args, **kwargs)
+            except ThrottledError:
+                # The operation may succeed once AWS stops throttling us, so the
+                # status is left as it was.
+                raise
             except Exception as e:
-                logger.error(e)
-                if "ExpiredTokenException" in str(e):
+                expired_code = expired_token_code(e)
+                if expired_code:
+                    # Expected once the user's credentials expire: not worth the
+                    # whole AWS error.
+                    logger.warning(
+                        "Expired credentials for %s %s - code: %s",
+                        type(self).__name__,
+                        self.id,
+                        expired_code,
+                    )
                     self.status = "EXPIRED_TOKEN"
                 else:
+                    logger.exception(
+                        "Error running %s for %s %s",
+                        function.__name__,
+                        type(self).__name__,
+                        self.id,
+                    )
                     self.status = on_error
                 raise
             else:
@@ -62,6 +86,91 @@ def status_handler(on_error, on_success=None):
     return decorator
 
 
+def job_flow_config_key(job_flow_config: dict) -> int:
+    """
+    Returns a fingerprint of `job_flow_config`, which is the same for equal configs
+    regardless of their keys order.
+    """
+    payload = dumps(job_flow_config, sort_keys=True)
+    return int.from_bytes(hashlib.blake2b(payload, digest_size=8).digest(), "little")
+
+
+def to_snapshot(value):
+    """
+    Makes an AWS response storable in a JSON column, formatting the values that
+    JSON can't represent (mainly datetimes) with `str`.
+    """
+    if isinstance(value, dict):
+        return {str(key): to_snapshot(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_snapshot(item) for item in value]
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    return str(value)
+
+
+# Prefix of the error codes AWS returns for expired credentials ("ExpiredToken",
+# "ExpiredTokenException")
+EXPIRED_TOKEN = "ExpiredToken"
+
+
+def expired_token_code(error: Exception) -> Optional[str]:
+    """
+    Returns the AWS error code behind `error` if it was caused by expired
+    credentials, else None.
+    """
+    client_error = aws_error(error)
+    if client_error is not None:
+        # Avoids formatting the error, which includes AWS' whole message.
+        code = client_error.response.get("Error", {}).get("Code") or ""
+        return code if code.startswith(EXPIRED_TOKEN) else None
+    return EXPIRED_TOKEN if EXPIRED_TOKEN in str(error) else None
+
+
+# Columns which aren't shown by the API, only used to manage the steps and clusters
+# in EMR. They are loaded when first accessed, unless the query undefers them with
+# `undefer_group(PAYLOAD_GROUP)`.
+PAYLOAD_GROUP = "payload"
+
+
+@lru_cache(maxsize=128)
+def _get_emr_handler(credentials: tuple) -> EMRHandler:
+    """
+    Returns an EMRHandler for the given credentials (a sorted tuple of their items).
+    Handlers only hold their client, so every row with the same credentials can
+    share one.
+    """
+    return EMRHandler(**dict(credentials))
+
+
+@lru_cache(maxsize=128)
+def _get_s3_handler(credentials: tuple) -> S3Handler:
+    """Same as `_get_emr_handler`, for S3Handlers."""
+    return S3Handler(**dict(credentials))
+
+
+class AWSHandlersMixin:
+    """
+    Gives access to the AWS handlers built from the `credentials` column. They are
+    only built the first time they are used, not every time a row is loaded.
+    """
+
+    @cached_property
+    def emr_handler(self) -> EMRHandler:
+        return _get_emr_handler(tuple(sorted(self.credentials["emr"].items())))
+
+    @cached_property
+    def s3_handler(self) -> S3Handler:
+        return _get_s3_handler(tuple(sorted(self.credentials["s3"].items())))
+
+
+# Plain values needed to retrieve the state of a cluster or step from EMR. Batches of
+# these, instead of the instances, are handed to the threads which retrieve the states,
+# since the instances belong to the session of the thread which loaded them.
+ClusterStatusTarget = namedtuple("ClusterStatusTarget", "id terminate_on emr_handler")
+StepStatusTarget = namedtuple("StepStatusTarget", "id step_id cluster_id emr_handler")
+
+
 class Base(db.Model):
     __abstract__ = True
 
@@ -70,8 +179,42 @@ class Base(db.Model):
         db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow
     )
 
+    @classmethod
+    def status_batches(cls, instances: list) -> List[list]:
+        """
+        Splits `instances` into the batches whose states are retrieved by a single
+        `fetch_new_states` call, holding each instance's `status_target`. By default,
+        each instance is a batch on its own.
+        """
+        return [[instance.status_target()] for instance in instances]
 
-class Step(Base):
+    @classmethod
+    def fetch_new_states(cls, batch: list) -> List[dict]:
+        """
+        Retrieves the states of a batch made by `status_batches` from EMR. Can run
+        in any thread, since it doesn't access the instances.
+
+        Returns:
+            list: the states to be applied with `bulk_apply_states`.
+        """
+        states = (cls.fetch_new_state(target) for target in batch)
+        return [state for state in states if state]
+
+    @classmethod
+    def bulk_apply_states(cls, session, states: List[dict]) -> None:
+        """
+        Applies the states returned by `fetch_new_states` to their rows, without
+        going through the objects' unit of work.
+
+        Args:
+            session (Session): session in which the UPDATE statements are emitted.
+            states (list): dicts with the primary key and the fields to update.
+        """
+        if states:
+            session.bulk_update_mappings(cls, states)
+
+
+class Step(AWSHandlersMixin, Base):
     """
     Taken from:
     https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/emr.html
@@ -85,30 +228,67 @@ class Step(Base):
     """
 
     __tablename__ = "steps"
+    __table_args__ = (
+        # Covers the status polls, filtering by status alone, too.
+        db.Index("ix_steps_status_cluster_id", "status", "cluster_id"),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(64), nullable=False)
     step_id = db.Column(db.String(64), nullable=True)
     status = db.Column(db.String(64), nullable=False)
-    cluster_id = db.Column(db.String(64), nullable=True)
+    cluster_id = db.Column(db.String(64), nullable=True, index=True)
     custom_metadata = db.Column(db.JSON, nullable=False)
     user = db.Column(db.String(64), nullable=False)
-    credentials = db.Column(Encrypted, nullable=False)
+    credentials = orm.deferred(
+        db.Column(Encrypted, nullable=False), group=PAYLOAD_GROUP
+    )
     is_test = db.Column(db.Boolean, nullable=False)
 
-    step_config = db.Column(db.JSON, nullable=False)
-    job_flow_config = db.Column(db.JSON, nullable=True)
+    step_config = orm.deferred(db.Column(db.JSON, nullable=False), group=PAYLOAD_GROUP)
+    job_flow_config = orm.deferred(
+        db.Column(db.JSON, nullable=True), group=PAYLOAD_GROUP
+    )
     properties_snapshot = db.Column(db.JSON, default={}, nullable=False)
 
-    TERMINATED_STATUS = [
-        "COMPLETED",
-        "CANCELLED",
-        "FAILED",
-        "INTERRUPTED",
-        "BAD_CONFIG",
-        "ERROR",
-        "EXPIRED_TOKEN",
-    ]
+    # A step can be assigned either to a StepsCluster or to a user's Cluster. These
+    # are read only: the assignment is done through `check_in`. List queries should
+    # load them with `selectinload`, to avoid a query per step, and fetch their rows
+    # with `all()` rather than streaming them with `yield_per`.
+    steps_cluster = db.relationship(
+        "StepsCluster",
+        primaryjoin="foreign(Step.cluster_id) == StepsCluster.id",
+        viewonly=True,
+    )
+    cluster = db.relationship(
+        "Cluster",
+        primaryjoin="foreign(Step.cluster_id) == Cluster.id",
+        viewonly=True,
+    )
+
+    TERMINATED_STATUS = frozenset(
+        {
+            "COMPLETED",
+            "CANCELLED",
+            "FAILED",
+            "INTERRUPTED",
+            "BAD_CONFIG",
+            "ERROR",
+            "EXPIRED_TOKEN",
+        }
+    )
+    # Status of the steps that may still change. Filtering by these, instead of
+    # excluding the terminated ones, lets the DB use the status index.
+    ACTIVE_STATUS = frozenset(
+        {
+            "UNASSIGNED",
+            "PENDING",
+            "CANCEL_PENDING",
+            "RUNNING",
+            "NO_UPDATE",
+            "CANCEL_ERROR",
+        }
+    )
     UNASSIGNED_STATUS = "UNASSIGNED"
 
     @status_handler(on_error="FAILED", on_success="UNASSIGNED")
@@ -126,19 +306,13 @@ class Step(Base):
             self.custom_metadata = custom_metadata
             self.is_test = is_test
             self.credentials = credentials
-            self.job_flow_config = OrderedDict(job_flow_config)
-            self.emr_handler = EMRHandler(**self.credentials["emr"])
-            self.s3_handler = S3Handler(**self.credentials["s3"])
+            self.job_flow_config = job_flow_config
 
             self.emr_handler.check_permissions()
             self.user = current_user.get_id()
 
             # Retrieved from AWS after step insertion
             self.step_id = None
-            self.logs_uri = None
-            self.created_on = None
-            self.started_on = None
-            self.ended_on = None
 
         except Exception as e:
             raise StepCreationError(
@@ -146,80 +320,143 @@ class Step(Base):
             )
 
     def __hash__(self):
-        hash = int(
-            "00".join([str(ord(elem)) for elem in json.dumps(self.job_flow_config)])
-        )
-        return hash
+        return self.config_key
 
-    @orm.reconstructor
-    def init_on_load(self):
-        # CAREFUL. Attributes that are not persisted
-        # in the DB can only be accessed after the
-        # reconstructor method has instantiated them.
-
-        self.s3_handler = S3Handler(**self.credentials["s3"])
-        self.emr_handler = EMRHandler(**self.credentials["emr"])
-
-        if self.cluster_id:
-            self.get_logs_uri()
-        self.get_timeline()
+    @cached_property
+    def config_key(self) -> int:
+        """
+        Identifies the job_flow_config, to match steps with the clusters that can run
+        them. Computed only once, since the job_flow_config isn't modified once set.
+        """
+        return job_flow_config_key(self.job_flow_config)
 
-    def get_timeline(self):
+    @cached_property
+    def timeline(self) -> dict:
         try:
-            timeline = self.properties_snapshot["Step"]["Status"]["Timeline"]
-        except KeyError:
-            return
-
-        self.created_on = timeline.get("CreationDateTime")
-        self.started_on = timeline.get("StartDateTime")
-        self.ended_on = timeline.get("EndDateTime")
+            return self.properties_snapshot["Step"]["Status"]["Timeline"]
+        except (KeyError, TypeError):
+            return {}
+
+    @property
+    def created_on(self) -> Optional[str]:
+        return self.timeline.get("CreationDateTime")
+
+    @property
+    def started_on(self) -> Optional[str]:
+        return self.timeline.get("StartDateTime")
+
+    @property
+    def ended_on(self) -> Optional[str]:
+        return self.timeline.get("EndDateTime")
+
+    @property
+    def assigned_cluster(self):
+        """The StepsCluster or Cluster to which this step was assigned, if any."""
+        if not self.cluster_id:
+            return None
+        return self.steps_cluster or self.cluster
+
+    @property
+    def logs_uri(self) -> Optional[str]:
+        cluster = self.assigned_cluster
+        if cluster is None:
+            if self.cluster_id:
+                logger.error(
+                    "The cluster %s, to which step %s was assigned, was not found",
+                    self.cluster_id,
+                    self.id,
+                )
+            return None
+        if not (cluster.logs_uri and self.step_id):
+            return None
+        return os.path.join(cluster.logs_uri, "steps", self.step_id)
 
-    def get_logs_uri(self):
-        try:
-            cluster = StepsCluster.query.get(self.cluster_id)
-            if not cluster:
-                cluster = Cluster.query.get(self.cluster_id)
-            if not cluster:
-                raise UpdateStatusError(
-                    "The cluster {}, to which step {} was assigned, was not found in the DB".format(
-                        self.cluster_id, self.id
-                    )
+    @classmethod
+    def status_batches(cls, steps: list) -> List[list]:
+        """
+        Groups the steps added to the same cluster with the same credentials, so that
+        their states are retrieved with a single ListSteps request. Steps which
+        haven't been added to a cluster yet are left out.
+        """
+        batches = defaultdict(list)
+        for step in steps:
+            if step.cluster_id and step.step_id:
+                target = StepStatusTarget(
+                    step.id, step.step_id, step.cluster_id, step.emr_handler
                 )
-        except Exception as e:
-            logger.error("Unable to get log URI - msg: {}".format(e))
-        else:
-            if cluster.logs_uri:
-                self.logs_uri = os.path.join(cluster.logs_uri, "steps", self.step_id)
+                # Equal credentials share their handler.
+                batches[(target.emr_handler, target.cluster_id)].append(target)
 
-    @status_handler(on_error="NO_UPDATE")
-    def update_status(self):
+        return [
+            batch[start : start + EMRHandler.LIST_STEPS_MAX_IDS]
+            for batch in batches.values()
+            for start in range(0, len(batch), EMRHandler.LIST_STEPS_MAX_IDS)
+        ]
+
+    @classmethod
+    def fetch_new_states(cls, batch: list) -> List[dict]:
         """
-        Updates a Step's status based on EMR status.
+        Retrieves the states of a batch made by `status_batches` from EMR. Can run
+        in any thread, since it doesn't access the steps.
 
-        Raises:
-            UpdateStatusError: when the status can't be retrieved from EMR.
+        Returns:
+            list: the steps' IDs and the fields to update, to be applied with
+                `bulk_apply_states`. Empty if the request was throttled.
 
         """
-        if self.cluster_id and self.step_id:
-            try:
-                response = self.emr_handler.describe_step(
-                    cluster_id=self.cluster_id, step_id=self.step_id
+        cluster_id = batch[0].cluster_id
+        step_ids = [step.step_id for step in batch]
+        try:
+            summaries = batch[0].emr_handler.list_steps(
+                cluster_id=cluster_id, step_ids=step_ids
+            )
+        except ThrottledError as e:
+            logger.warning(
+                "Throttled updating status for steps %s - msg: %s", step_ids, e
+            )
+            return []
+        except UpdateStatusError as e:
+            expired_code = expired_token_code(e)
+            if expired_code:
+                logger.warning(
+                    "Expired credentials for steps %s - code: %s",
+                    step_ids,
+                    expired_code,
                 )
-                self.properties_snapshot = json.loads(json.dumps(response, default=str))
-            except UpdateStatusError as e:
+                status = "EXPIRED_TOKEN"
+            else:
                 logger.error(
-                    "Error updating status for step {} - msg: {}".format(
-                        self.step_id, e
-                    )
+                    "Error updating status for steps %s - msg: %s", step_ids, e
                 )
-                raise
+                status = "NO_UPDATE"
+            return [{"id": step.id, "status": status} for step in batch]
+
+        summaries = {summary["Id"]: summary for summary in summaries}
+        states = []
+        for step in batch:
+            summary = summaries.get(step.step_id)
+            if summary is None:
+                logger.error(
+                    "Step %s was not found in cluster %s", step.step_id, cluster_id
+                )
+                states.append({"id": step.id, "status": "NO_UPDATE"})
+                continue
+
+            states.append(
+                {
+                    "id": step.id,
+                    "status": summary["Status"]["State"],
+                    # Stored like DescribeStep's responses, which have the same fields.
+                    "properties_snapshot": to_snapshot({"Step": summary}),
+                }
+            )
 
-            self.status = response["Step"]["Status"]["State"]
+        return states
 
     @status_handler(on_error="FAILED", on_success="PENDING")
     def check_in(self, cluster_id: str, step_id: str) -> None:
         """Steps are added to Clusters in EMR. This method checks in the step in the application."""
-        logger.info("Added step {} to cluster {}".format(step_id, cluster_id))
+        logger.info("Added step %s to cluster %s", step_id, cluster_id)
         self.cluster_id = cluster_id
         self.step_id = step_id
 
@@ -232,7 +469,7 @@ class Step(Base):
         """
 
         if self.cluster_id:
-            cluster = StepsCluster.query.get(self.cluster_id)
+            cluster = self.assigned_cluster
             if not cluster.is_terminated():
                 try:
                     self.emr_handler.cancel_steps(
@@ -240,14 +477,13 @@ class Step(Base):
                     )
                 except StepCancelError as e:
                     logger.error(
-                        "Error cancelling step {} in cluster {} - msg: {}".format(
-                            self.id, self.cluster_id, e
-                        )
+                        "Error cancelling step %s in cluster %s - msg: %s",
+                        self.id,
+                        self.cluster_id,
+                        e,
                     )
 
-        logger.info(
-            "Terminating step {} in cluster {}".format(self.id, self.cluster_id)
-        )
+        logger.info("Terminating step %s in cluster %s", self.id, self.cluster_id)
 
     def metrics(self) -> (str, dict):
         return datadog_metric(
@@ -262,7 +498,7 @@ class Step(Base):
         )
 
 
-class Cluster(Base):
+class Cluster(AWSHandlersMixin, Base):
 
     """
     Taken from:
@@ -280,21 +516,52 @@ class Cluster(Base):
     id = db.Column(db.String(64), primary_key=True)
     status = db.Column(db.String(64), nullable=False)
     terminate_on = db.Column(db.DateTime)
-    assigned_steps = db.Column(db.PickleType)
+    assigned_steps = db.Column(JSONBlob)
     user = db.Column(db.String(64), nullable=False)
-    credentials = db.Column(Encrypted, nullable=False)
-    job_flow_config = db.Column(db.JSON, nullable=False)
+    credentials = orm.deferred(
+        db.Column(Encrypted, nullable=False), group=PAYLOAD_GROUP
+    )
+    job_flow_config = orm.deferred(
+        db.Column(db.JSON, nullable=False), group=PAYLOAD_GROUP
+    )
     properties_snapshot = db.Column(db.JSON, default={}, nullable=False)
 
-    TERMINATED_STATUS = ["TERMINATED", "TERMINATED_WITH_ERRORS", "EXPIRED_TOKEN"]
+    TERMINATED_STATUS = frozenset(
+        {"TERMINATED", "TERMINATED_WITH_ERRORS", "EXPIRED_TOKEN"}
+    )
+    # Status of the clusters that may still change. Filtering by these, instead of
+    # excluding the terminated ones, lets the DB use the status index.
+    ACTIVE_STATUS = frozenset(
+        {
+            "STARTING",
+            "BOOTSTRAPPING",
+            "RUNNING",
+            "WAITING",
+            "TERMINATING",
+            "NO_UPDATE",
+            "ERROR",
+        }
+    )
     UNASSIGNED_STATUS = "WAITING"
 
+    # Master DNS Name format: "ip-10-63-57-26.ec2.internal"
+    MASTER_DNSNAME_PATTERN = re.compile(r"^[^.-]+-(\d+)-(\d+)-(\d+)-(\d+)\.")
+
+    @declared_attr
+    def __table_args__(cls):
+        # Declared per class, so that StepsCluster's table gets its own index.
+        return (
+            db.Index(
+                "ix_{}_status_terminate_on".format(cls.__tablename__),
+                "status",
+                "terminate_on",
+            ),
+        )
+
     @status_handler(on_error="TERMINATED", on_success="STARTING")
     def __init__(self, credentials: dict, job_flow_config: dict, lifetime: int = 240):
         self.credentials = credentials
-        self.job_flow_config = OrderedDict(job_flow_config)
-        self.emr_handler = EMRHandler(**self.credentials["emr"])
-        self.s3_handler = S3Handler(**self.credentials["s3"])
+        self.job_flow_config = job_flow_config
         self.assigned_steps = []
 
         self.user = current_user.get_id()
@@ -303,36 +570,42 @@ class Cluster(Base):
         # Retrieved from AWS after initialization
         self.id = None
         self.status = None
-        self.ip_address = None
-        self.logs_uri = None
-        self.created_on = None
-        self.ready_on = None
-        self.ended_on = None
 
     def __hash__(self):
-        hash = int(
-            "00".join([str(ord(elem)) for elem in json.dumps(self.job_flow_config)])
-        )
-        return hash
+        return self.config_key
 
-    @orm.reconstructor
-    def init_on_load(self):
-        # CAREFUL. Attributes that are not persisted
-        # in the DB can only be accessed after the
-        # reconstructor method has instantiated them.
-        self.s3_handler = S3Handler(**self.credentials["s3"])
-        self.emr_handler = EMRHandler(**self.credentials["emr"])
-
-        if self.properties_snapshot:
-            self.ip_address = self._master_dnsname_to_ip()
-            logs_uri = self.properties_snapshot.get("Cluster").get("LogUri")
-            self.logs_uri = os.path.join(logs_uri, self.id)
-            self.tags = self.properties_snapshot.get("Cluster").get("Tags")
-            self.get_timeline()
-        else:
-            self.ip_address = None
-            self.logs_uri = None
-            self.tags = None
+    @cached_property
+    def config_key(self) -> int:
+        """
+        Identifies the job_flow_config, to match steps with the clusters that can run
+        them. Computed only once, since the job_flow_config isn't modified once set.
+        """
+        return job_flow_config_key(self.job_flow_config)
+
+    # The fields taken from the snapshot are computed the first time they are read.
+    # Snapshots are only replaced through `bulk_apply_states`, which doesn't modify
+    # loaded objects, so they can be cached for the object's lifetime.
+
+    @cached_property
+    def description(self) -> dict:
+        """The cluster's description in the last snapshot retrieved from EMR."""
+        if not self.properties_snapshot:
+            return {}
+        return self.properties_snapshot.get("Cluster") or {}
+
+    @cached_property
+    def ip_address(self) -> Optional[str]:
+        return self._master_dnsname_to_ip()
+
+    @cached_property
+    def logs_uri(self) -> Optional[str]:
+        logs_uri = self.description.get("LogUri")
+        if logs_uri:
+            return os.path.join(logs_uri, self.id)
+
+    @cached_property
+    def tags(self) -> Optional[list]:
+        return self.description.get("Tags")
 
     def _master_dnsname_to_ip(self):
         """
@@ -341,23 +614,27 @@ class Cluster(Base):
         Master DNS Name format: "ip-10-63-57-26.ec2.internal"
         Output IP: "10.63.57.26"
         """
-        master_dnsname = self.properties_snapshot.get("Cluster").get(
-            "MasterPublicDnsName"
-        )
+        master_dnsname = self.description.get("MasterPublicDnsName")
         if master_dnsname:
-            ip = master_dnsname.split(".")[0]
-            ip = ".".join(ip.split("-")[1:])
-            return ip
+            match = self.MASTER_DNSNAME_PATTERN.match(master_dnsname)
+            if match:
+                return ".".join(match.groups())
 
-    def get_timeline(self):
-        try:
-            timeline = self.properties_snapshot["Cluster"]["Status"]["Timeline"]
-        except KeyError:
-            return
+    @cached_property
+    def timeline(self) -> dict:
+        return self.description.get("Status", {}).get("Timeline", {})
 
-        self.created_on = timeline.get("CreationDateTime")
-        self.ready_on = timeline.get("ReadyDateTime")
-        self.ended_on = timeline.get("EndDateTime")
+    @property
+    def created_on(self) -> Optional[str]:
+        return self.timeline.get("CreationDateTime")
+
+    @property
+    def ready_on(self) -> Optional[str]:
+        return self.timeline.get("ReadyDateTime")
+
+    @property
+    def ended_on(self) -> Optional[str]:
+        return self.timeline.get("EndDateTime")
 
     @status_handler(on_error="ERROR", on_success="STARTING")
     def create(self):
@@ -371,9 +648,9 @@ class Cluster(Base):
         """
         try:
             self.id = self.emr_handler.create_cluster(self.job_flow_config)
-            logger.info(f"Created cluster {self.id}")
+            logger.info("Created cluster %s", self.id)
         except CreateClusterError as e:
-            logger.error("Error creating cluster {} - msg: {}".format(self.id, e))
+            logger.error("Error creating cluster %s - msg: %s", self.id, e)
             raise
 
     @status_handler(on_error="ERROR")
@@ -393,7 +670,7 @@ class Cluster(Base):
             UnableToAssignStepError: when step cannot be assigned.
 
         """
-        logger.info("Adding a step to cluster {}".format(self.id))
+        logger.info("Adding a step to cluster %s", self.id)
         try:
             inserted_step_id = self.emr_handler.add_step_to_cluster(
                 cluster_id=self.id, step=step
@@ -401,44 +678,60 @@ class Cluster(Base):
 
         except UnableToAssignStepError as e:
             logger.error(
-                "Error adding step {} to cluster {} - msg {}".format(
-                    step.id, self.id, e
-                )
+                "Error adding step %s to cluster %s - msg %s", step.id, self.id, e
             )
             raise
 
         else:
-            self.assigned_steps.append(inserted_step_id)
+            # Reassigned, since changes made in place aren't tracked.
+            self.assigned_steps = self.assigned_steps + [inserted_step_id]
             self.terminate_on = None
 
         return self.id, inserted_step_id
 
-    @status_handler(on_error="NO_UPDATE")
-    def update_status(self):
+    def status_target(self) -> ClusterStatusTarget:
+        return ClusterStatusTarget(self.id, self.terminate_on, self.emr_handler)
+
+    @staticmethod
+    def fetch_new_state(target: ClusterStatusTarget) -> Optional[dict]:
         """
-        Updates cluster's status based on EMR status.
+        Retrieves a cluster's status from EMR, given its `status_target`.
 
-        Raises:
-            UpdateStatusError: when the status can't be retrieved from EMR.
+        Returns:
+            dict: the cluster's ID and the fields to update, to be applied with
+                `bulk_apply_states`. None if the request was throttled.
 
         """
 
         try:
-            response = self.emr_handler.describe_cluster(cluster_id=self.id)
-            # Dump dict to json with default=str to overcome 'datetime object not serializable'.
-            # Then load it again. Masterful.
-            self.properties_snapshot = json.loads(json.dumps(response, default=str))
-        except UpdateStatusError as e:
-            logger.error(
-                "Error updating status for cluster {} - msg: {}".format(self.id, e)
+            response = target.emr_handler.describe_cluster(cluster_id=target.id)
+        except ThrottledError as e:
+            logger.warning(
+                "Throttled updating status for cluster %s - msg: %s", target.id, e
             )
-            raise
+            return None
+        except UpdateStatusError as e:
+            expired_code = expired_token_code(e)
+            if expired_code:
+                logger.warning(
+                    "Expired credentials for cluster %s - code: %s",
+                    target.id,
+                    expired_code,
+                )
+                return {"id": target.id, "status": "EXPIRED_TOKEN"}
+            logger.error("Error updating status for cluster %s - msg: %s", target.id, e)
+            return {"id": target.id, "status": "NO_UPDATE"}
 
-        self.status = response["Cluster"]["Status"]["State"]
+        state = {
+            "id": target.id,
+            "status": response["Cluster"]["Status"]["State"],
+            "properties_snapshot": to_snapshot(response),
+        }
 
-        if not self.terminate_on and self.status == Cluster.UNASSIGNED_STATUS:
+        if not target.terminate_on and state["status"] == Cluster.UNASSIGNED_STATUS:
+            state["terminate_on"] = datetime.utcnow() + timedelta(minutes=15)
 
-            self.terminate_on = datetime.utcnow() + timedelta(minutes=15)
+        return state
 
     @status_handler(on_error="TERMINATED_WITH_ERRORS", on_success="TERMINATED")
     def terminate(self):
@@ -450,15 +743,41 @@ class Cluster(Base):
 
         """
         try:
-            logger.info("Terminating cluster {}".format(self.id))
+            logger.info("Terminating cluster %s", self.id)
             self.emr_handler.terminate_cluster(cluster_id=self.id)
         except UnableToTerminateClusterError as e:
-            logger.error("Terminating cluster {} - msg: {}".format(self.id, e))
+            logger.error("Terminating cluster %s - msg: %s", self.id, e)
             raise
 
+    @status_handler(on_error="TERMINATED_WITH_ERRORS", on_success="TERMINATED")
+    def apply_termination(self, error: Optional[Exception] = None) -> None:
+        """
+        Sets the status resulting from a termination requested to EMR without this
+        object, e.g. from a worker thread, which must not modify it.
+
+        Args:
+            error (Exception): raised by the termination request, if it failed.
+
+        """
+        if error is not None:
+            raise error
+
     def is_terminated(self) -> bool:
         return self.status in self.TERMINATED_STATUS
 
+    @classmethod
+    def expired_filter(cls, now: datetime):
+        """
+        Returns the filter for clusters which are expired at `now`, i.e. that have
+        a `terminate_on` date older than `now` and aren't terminated yet.
+        """
+        return and_(
+            cls.status.in_(cls.ACTIVE_STATUS),
+            cls.terminate_on != None,
+            # read this as: terminate_on is older than now.
+            cls.terminate_on < now,
+        )
+
     def metrics(self) -> (str, dict):
         return datadog_metric(
             self.__class__.__name__.lower(),
@@ -478,9 +797,13 @@ class StepsCluster(Cluster):
     id = db.Column(db.String(64), primary_key=True)
     status = db.Column(db.String(64), nullable=False)
     terminate_on = db.Column(db.DateTime)
-    assigned_steps = db.Column(db.PickleType, nullable=False)
-    credentials = db.Column(Encrypted, nullable=False)
-    job_flow_config = db.Column(db.JSON, nullable=False)
+    assigned_steps = db.Column(JSONBlob, nullable=False)
+    credentials = orm.deferred(
+        db.Column(Encrypted, nullable=False), group=PAYLOAD_GROUP
+    )
+    job_flow_config = orm.deferred(
+        db.Column(db.JSON, nullable=False), group=PAYLOAD_GROUP
+    )
     properties_snapshot = db.Column(db.JSON, default={}, nullable=False)
     # waiting_since = db.Column(db.DateTime)
     # last_added_step = db.Column(db.DateTime, default=datetime.utcnow())
@@ -490,6 +813,21 @@ class StepsCluster(Cluster):
     user = "manager"
 
 
+@lru_cache(maxsize=128)
+def _download_configuration(s3_uri: str) -> str:
+    """
+    Retrieves a configuration's content from s3.
+
+    Stored configurations are never overwritten: each upload gets a new version and,
+    therefore, a new s3_uri. This makes it safe to cache their content by URI.
+    """
+    s3_handler = S3Handler(
+        aws_access_key_id=os.getenv("SECRET_ACCESS_KEY"),
+        aws_secret_access_key=os.getenv("SECRET_SECRET_KEY"),
+    )
+    return s3_handler.download(s3_uri)
+
+
 class ClusterConfiguration(Base):
     """A class for cluster configurations to be stored and retrieved from s3.
     These are used in requests to instantiate clusters with a particular configuration."""
@@ -539,14 +877,14 @@ class ClusterConfiguration(Base):
 
         """
 
-        configuration_content = json.dumps(self.job_flow_config)
+        configuration_content = dumps(self.job_flow_config).decode()
         try:
             self.s3_handler.upload(
                 destination_uri=self.s3_uri, content=configuration_content
             )
         except UnableToUploadContentError as e:
             logger.error(
-                "Unable to upload config {} - msg: {}".format(self.job_flow_config, e)
+                "Unable to upload config %s - msg: %s", self.job_flow_config, e
             )
             raise
 
@@ -554,6 +892,8 @@ class ClusterConfiguration(Base):
         """Retrieves the config from s3 and stores it as a JSON in the
         'job_flow_config' attribute of the object.
         """
-        configuration_content = self.s3_handler.download(self.s3_uri)
-        configuration = json.loads(configuration_content)
+        # The cached content is parsed on every call so that callers can freely
+        # modify the resulting dict.
+        configuration_content = _download_configuration(self.s3_uri)
+        configuration = loads(configuration_content)
         self.job_flow_config = configuration
@@ -1,20 +1,51 @@
-import json
+import pickle
+
+from app.serializers import dumps, loads
 
 import sqlalchemy.types as types
 from cryptography.fernet import Fernet
 
 
+# TODO: should be secured in production
+ENCRYPTOR = Fernet(b"o78wbST5GH4zBfjZ1xwzyyamaKD2d9FFq12y0nXe4kY=")
+
+
 class Encrypted(types.TypeDecorator):
 
     impl = types.BLOB
-
-    # TODO: should be secured in production
-    ENCRYPTOR = Fernet(b"o78wbST5GH4zBfjZ1xwzyyamaKD2d9FFq12y0nXe4kY=")
+    cache_ok = True
 
     def process_bind_param(self, value, dialect):
-        encrypted_value = self.ENCRYPTOR.encrypt(json.dumps(value).encode("utf-8"))
+        encrypted_value = ENCRYPTOR.encrypt(dumps(value))
         return encrypted_value
 
     def process_result_value(self, value, dialect):
-        decrypted_value = json.loads(self.ENCRYPTOR.decrypt(value))
+        decrypted_value = loads(ENCRYPTOR.decrypt(bytes(value)))
         return decrypted_value
+
+
+class JSONBlob(types.TypeDecorator):
+    """
+    Stores a JSON value in a BLOB column. Replaces PickleType, so values stored
+    before the switch are pickled; those are still read, and rewritten as JSON the
+    next time they are saved.
+    """
+
+    impl = types.BLOB
+    cache_ok = True
+
+    # Every pickle written with protocol 2 or newer starts with the PROTO opcode.
+    PICKLE_PREFIX = b"\x80"
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return dumps(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        value = bytes(value)
+        if value.startswith(self.PICKLE_PREFIX):
+            return pickle.loads(value)
+        return loads(value)
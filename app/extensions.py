@@ -1,7 +1,24 @@
 from flask_ldap3_login import LDAP3LoginManager
 from flask_login import LoginManager
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.orm import raiseload
 
 ldap_manager = LDAP3LoginManager()
 login_manager = LoginManager()
 db = SQLAlchemy()
+
+
+def raiseload_by_default(orm_execute_state):
+    """
+    `do_orm_execute` listener that makes the relationships of the queried objects
+    raise when they are lazy loaded, unless the query loads them explicitly (e.g.
+    with `selectinload`). Turns accidental N+1 queries into errors.
+    """
+    if (
+        orm_execute_state.is_select
+        and not orm_execute_state.is_column_load
+        and not orm_execute_state.is_relationship_load
+    ):
+        orm_execute_state.statement = orm_execute_state.statement.options(
+            raiseload("*")
+        )
@@ -1,3 +1,9 @@
+import hashlib
+import hmac
+import os
+import time
+from threading import Lock
+
 from app.utils import logger
 from app.extensions import db, login_manager, ldap_manager
 from app.login.errors import UnableToLoginError
@@ -7,6 +13,22 @@ from tiger_python_helper.services.tiger_service import TigerService
 from tiger_python_helper.exceptions.tiger_authentication_error import TigerAuthenticationException
 
 
+"""
+Successful logins are remembered for LOGIN_CACHE_TTL seconds, so that clients
+logging in repeatedly (e.g. on every page load) don't hit Tiger every time.
+The tradeoff is that, within each process, a changed password or a revoked user
+can still log in until the entry expires. Failed logins are never cached, and
+passwords are only kept as an HMAC keyed with a secret that never leaves the process.
+"""
+
+LOGIN_CACHE_TTL = 60
+LOGIN_CACHE_MAX_SIZE = 1024
+
+_login_cache_secret = os.urandom(32)
+# (username, password HMAC) -> expiration time, in insertion order
+_login_cache = {}
+_login_cache_lock = Lock()
+
 
 class User(UserMixin, db.Model):
     # User's AD will be its ID
@@ -21,17 +43,45 @@ def is_valid_user(user: str) -> bool:
 
 
 def validate_user(username: str, password: str):
-    try:
-        service = TigerService()
-        service.get_user_token(username, password)
-    except TigerAuthenticationException as e:
-        logger.info("Unable to login user {} - {}".format(username, e))
-        raise UnableToLoginError("Unable to log in")
+    cache_key = _login_cache_key(username, password)
+    if not _is_cached_login(cache_key):
+        try:
+            service = TigerService()
+            service.get_user_token(username, password)
+        except TigerAuthenticationException as e:
+            logger.info("Unable to login user {} - {}".format(username, e))
+            raise UnableToLoginError("Unable to log in")
+        _cache_login(cache_key)
     return get_or_save_user(username)
 
 
+def _login_cache_key(username: str, password: str) -> tuple:
+    digest = hmac.new(_login_cache_secret, password.encode(), hashlib.sha256)
+    return username, digest.digest()
+
+
+def _is_cached_login(cache_key: tuple) -> bool:
+    with _login_cache_lock:
+        expires_at = _login_cache.get(cache_key)
+        if expires_at is None:
+            return False
+        if expires_at <= time.monotonic():
+            del _login_cache[cache_key]
+            return False
+        return True
+
+
+def _cache_login(cache_key: tuple) -> None:
+    with _login_cache_lock:
+        _login_cache.pop(cache_key, None)
+        _login_cache[cache_key] = time.monotonic() + LOGIN_CACHE_TTL
+        # Evict the oldest entries
+        while len(_login_cache) > LOGIN_CACHE_MAX_SIZE:
+            del _login_cache[next(iter(_login_cache))]
+
+
 def get_or_save_user(username):
-    user = User.query.get(username)
+    user = db.session.get(User, username)
     if not user:
         user = User(id=username)
         db.session.add(user)
@@ -41,4 +91,4 @@ def get_or_save_user(username):
 
 @login_manager.user_loader
 def load_user(id):
-    return User.query.get(id)
+    return db.session.get(User, id)
@@ -0,0 +1,69 @@
+import queue
+from threading import Lock, Thread
+
+from app.utils import logger, DatadogMetric
+
+from melitk import metrics
+from melitk.metrics.exceptions import MetricsError
+
+
+"""
+Datadog metrics are posted from a background thread so that a slow agent doesn't
+add latency to the requests that record them. Metrics are dropped (and logged)
+if the queue is full.
+"""
+
+MAX_PENDING_METRICS = 10000
+
+_pending_metrics = queue.Queue(maxsize=MAX_PENDING_METRICS)
+
+_worker = None
+_worker_lock = Lock()
+
+
+def record_count(datadog_metric: DatadogMetric, increment: int = 1) -> None:
+    """Queues a count metric to be posted by the background worker."""
+    _ensure_worker()
+    try:
+        _pending_metrics.put_nowait((datadog_metric, increment))
+    except queue.Full:
+        logger.info(
+            "Unable to queue {} metric with tags {} - msg: queue is full".format(
+                datadog_metric.metric_name, datadog_metric.tags
+            )
+        )
+
+
+def _ensure_worker() -> None:
+    # The worker is started lazily, so that each gunicorn worker process
+    # starts its own thread after being forked.
+    global _worker
+    if _worker is not None and _worker.is_alive():
+        return
+
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = Thread(target=_post_metrics, name="metrics-sink", daemon=True)
+            _worker.start()
+
+
+def _post_metrics() -> None:
+    while True:
+        datadog_metric, increment = _pending_metrics.get()
+        try:
+            metrics.record_count(
+                name=datadog_metric.metric_name,
+                increment=increment,
+                tags=datadog_metric.tags,
+            )
+        except MetricsError as e:
+            logger.info(
+                "Unable to post {} metric with tags {} - msg: {}".format(
+                    datadog_metric.metric_name, datadog_metric.tags, e
+                )
+            )
+        except Exception as e:
+            # Keep the worker alive no matter what happens with a single metric.
+            logger.error(e)
+        finally:
+            _pending_metrics.task_done()
@@ -1,3 +1,5 @@
+from functools import lru_cache
+
 from app.utils import logger, is_prod
 
 from melitk.bigqueue import Producer
@@ -29,4 +31,10 @@ def producer():
     return LocalProducer(base_url=base_url, topic=topic, logger=None)
 
 
-steps_producer = producer()
+@lru_cache(maxsize=1)
+def steps_producer():
+    """
+    Returns the producer for the steps topic, created the first time a step is
+    published instead of when this module is imported.
+    """
+    return producer()
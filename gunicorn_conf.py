@@ -1,21 +1,49 @@
 # Reference: http://docs.gunicorn.org/en/stable/configure.html#configuration-file
+import gc
 import multiprocessing
 from os import environ
 
 
 # http://docs.gunicorn.org/en/stable/settings.html#workers
-# workers = multiprocessing.cpu_count() * 2 + 1
-workers = 2
+workers = int(environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
 
 # http://docs.gunicorn.org/en/stable/settings.html#bind
 bind = "0.0.0.0:8080"
 
 # http://docs.gunicorn.org/en/stable/settings.html#worker-class
-worker_class = "gevent"
-# worker_class = "sync"
+# Requests spend most of their time waiting on EMR, s3 and MySQL, so threads
+# let a worker serve other requests meanwhile. boto3, the MySQL driver and Fernet
+# release the GIL while they wait or compute, without gevent's monkey patching.
+# Can be overridden with WORKER_CLASS to compare them (e.g. "gevent" or "sync").
+worker_class = environ.get("WORKER_CLASS", "gthread")
+# gevent and eventlet workers monkey patch the standard library when they start.
+is_async_worker = any(name in worker_class for name in ("gevent", "eventlet"))
+
+# http://docs.gunicorn.org/en/stable/settings.html#preload-app
+# The app is imported once, by the master, and its workers share those pages.
+# Any DB connection opened while importing it (i.e. creating the schema in
+# development) is disposed of before forking, so none is shared between workers.
+# Not done for async workers: their patching would come after boto3, the MySQL
+# driver and threading were imported and set up unpatched in the master.
+preload_app = not is_async_worker
+
+# http://docs.gunicorn.org/en/stable/settings.html#threads
+# Each thread may hold a connection from its worker's SQLAlchemy pool, which is sized
+# from this same variable (see SQLALCHEMY_ENGINE_OPTIONS in app/config.py).
+threads = int(environ.get("THREADS", 8))
 
 # http://docs.gunicorn.org/en/stable/settings.html#worker-connections
-worker_connections = 1001
+# Only used by async workers: gthread workers serve up to `threads` at a time.
+if is_async_worker:
+    worker_connections = 1001
 
 # http://docs.gunicorn.org/en/stable/settings.html#timeout
 timeout = environ["TIMEOUT"]
+
+
+# http://docs.gunicorn.org/en/stable/settings.html#pre-fork
+def pre_fork(server, worker):
+    # Moves the objects created while loading the app out of the GC's reach, so
+    # that collections in the workers don't write to (and copy) the shared pages.
+    gc.collect()
+    gc.freeze()
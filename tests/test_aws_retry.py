@@ -0,0 +1,141 @@
+import pytest
+from botocore.exceptions import ClientError, EndpointConnectionError
+
+from app.core.aws_handler import (
+    aws_error,
+    aws_retry,
+    THROTTLING_ERROR_CODES,
+)
+from app.core.errors import UpdateStatusError
+
+
+def client_error(code: str) -> ClientError:
+    return ClientError({"Error": {"Code": code, "Message": "msg"}}, "DescribeCluster")
+
+
+def failing(*errors, result="ok"):
+    """Returns a function raising `errors` in order, and then returning `result`."""
+    calls = []
+
+    def function():
+        calls.append(None)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return result
+
+    function.calls = calls
+    return function
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Records the waits between attempts, which take the largest allowed value."""
+    sleeps = []
+    monkeypatch.setattr("app.core.aws_handler.time.sleep", sleeps.append)
+    monkeypatch.setattr("app.core.aws_handler.random.uniform", lambda low, high: high)
+    return sleeps
+
+
+def test_aws_error_returns_the_client_error_itself():
+    error = client_error("Throttling")
+
+    assert aws_error(error) is error
+
+
+def test_aws_error_walks_the_cause_chain():
+    error = client_error("ExpiredToken")
+    try:
+        try:
+            raise error
+        except ClientError as e:
+            raise UpdateStatusError("Error updating") from e
+    except UpdateStatusError as e:
+        wrapped = e
+
+    assert aws_error(wrapped) is error
+
+
+def test_aws_error_walks_the_context_chain():
+    error = client_error("ExpiredToken")
+    try:
+        try:
+            raise error
+        except ClientError:
+            raise ValueError("raised while handling it")
+    except ValueError as e:
+        wrapped = e
+
+    assert aws_error(wrapped) is error
+
+
+def test_aws_error_without_client_error():
+    assert aws_error(ValueError("not from AWS")) is None
+
+
+def test_retries_until_success(sleeps):
+    function = failing(client_error("Throttling"), client_error("InternalFailure"))
+
+    assert aws_retry()(function)() == "ok"
+    assert len(function.calls) == 3
+
+
+def test_waits_are_full_jitter_with_exponential_bound(sleeps, monkeypatch):
+    bounds = []
+    monkeypatch.setattr(
+        "app.core.aws_handler.random.uniform",
+        lambda low, high: bounds.append((low, high)) or high,
+    )
+    function = failing(*[client_error("Throttling")] * 4)
+
+    aws_retry(max_attempts=5, base=1.0, cap=5.0)(function)()
+
+    assert bounds == [(0, 1.0), (0, 2.0), (0, 4.0), (0, 5.0)]
+    assert sleeps == [1.0, 2.0, 4.0, 5.0]
+
+
+def test_gives_up_after_max_attempts(sleeps):
+    error = client_error("Throttling")
+    function = failing(*[error] * 3)
+
+    with pytest.raises(ClientError) as raised:
+        aws_retry(max_attempts=3)(function)()
+
+    assert raised.value is error
+    assert len(function.calls) == 3
+    assert len(sleeps) == 2
+
+
+def test_doesnt_retry_other_errors(sleeps):
+    function = failing(client_error("ValidationException"))
+
+    with pytest.raises(ClientError):
+        aws_retry()(function)()
+
+    assert len(function.calls) == 1
+    assert sleeps == []
+
+
+def test_retry_on_limits_the_retried_codes(sleeps):
+    function = failing(client_error("InternalFailure"))
+
+    with pytest.raises(ClientError):
+        aws_retry(retry_on=THROTTLING_ERROR_CODES)(function)()
+
+    assert len(function.calls) == 1
+
+
+def test_retries_errors_caused_by_retryable_ones(sleeps):
+    cause = client_error("ServiceUnavailable")
+    error = UpdateStatusError("Error updating")
+    error.__cause__ = cause
+    function = failing(error)
+
+    assert aws_retry()(function)() == "ok"
+    assert len(function.calls) == 2
+
+
+def test_retries_connection_errors(sleeps):
+    function = failing(EndpointConnectionError(endpoint_url="https://emr"))
+
+    assert aws_retry(retry_on=THROTTLING_ERROR_CODES)(function)() == "ok"
+    assert len(function.calls) == 2
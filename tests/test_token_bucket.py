@@ -0,0 +1,91 @@
+import pytest
+
+from app.core import TokenBucket
+
+
+class FakeClock:
+    """Replaces `time.monotonic` and `time.sleep`, recording the sleeps."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr("app.core.time.monotonic", clock.monotonic)
+    monkeypatch.setattr("app.core.time.sleep", clock.sleep)
+    return clock
+
+
+def test_try_acquire_takes_up_to_capacity_tokens(clock):
+    bucket = TokenBucket(capacity=3, refill_rate=1.0)
+
+    assert [bucket.try_acquire() for _ in range(4)] == [True, True, True, False]
+
+
+def test_try_acquire_when_empty_doesnt_take_a_token(clock):
+    bucket = TokenBucket(capacity=1, refill_rate=1.0)
+    bucket.try_acquire()
+
+    assert not bucket.try_acquire()
+    assert not bucket.try_acquire()
+    clock.now += 1
+    assert bucket.try_acquire()
+
+
+def test_tokens_are_refilled_at_refill_rate(clock):
+    bucket = TokenBucket(capacity=2, refill_rate=0.5)
+    bucket.try_acquire()
+    bucket.try_acquire()
+
+    clock.now += 1
+    assert not bucket.try_acquire()
+    clock.now += 1
+    assert bucket.try_acquire()
+
+
+def test_refill_is_capped_at_capacity(clock):
+    bucket = TokenBucket(capacity=2, refill_rate=1.0)
+    bucket.try_acquire()
+
+    clock.now += 60
+    assert [bucket.try_acquire() for _ in range(3)] == [True, True, False]
+
+
+def test_acquire_doesnt_sleep_while_tokens_are_available(clock):
+    bucket = TokenBucket(capacity=2, refill_rate=1.0)
+
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == 0
+    assert clock.sleeps == []
+
+
+def test_acquire_sleeps_until_its_token_is_refilled(clock):
+    bucket = TokenBucket(capacity=1, refill_rate=2.0)
+    bucket.acquire()
+
+    assert bucket.acquire() == pytest.approx(0.5)
+    assert clock.sleeps == [pytest.approx(0.5)]
+
+
+def test_acquire_reserves_consecutive_tokens(monkeypatch, clock):
+    # Concurrent callers take their tokens before sleeping, so each one waits for
+    # the next token instead of competing for the same one.
+    monkeypatch.setattr("app.core.time.sleep", clock.sleeps.append)
+    bucket = TokenBucket(capacity=1, refill_rate=1.0)
+
+    waits = [bucket.acquire() for _ in range(3)]
+
+    assert waits == [0, pytest.approx(1), pytest.approx(2)]
+    # The reserved tokens aren't available to try_acquire either.
+    clock.now += 1
+    assert not bucket.try_acquire()